@@ -0,0 +1,365 @@
+"""
+Benchmark the helper functions on synthetic CTN-0027 cohorts of any size.
+
+The generator reproduces the shapes of the raw tables used in the project (T_FRRSA, T_FRUDSAB,
+T_FRDOS, with their CRF metadata columns) and of the wide 42_features layout, so every step
+of the pipeline can be timed offline at 1k, 100k or 1M patients. Wall time and peak memory
+are recorded per function and size, and saved to csv to compare against a previous run.
+
+Examples:
+    python benchmark.py --sizes 1000 10000 --output ../benchmarks/results.csv
+    python benchmark.py --sizes 1000 10000 --baseline ../benchmarks/results.csv
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import helper
+
+# visit labels as they appear in the raw tables
+RSA_VISITS = ["BASELINE"] + [f"WK{i}" for i in range(0, 25)] + ["WK28", "WK32"]
+UDS_VISITS = ["BASELINE"] + [f"WK{i}" for i in range(1, 25)]
+DOS_VISITS = [f"WK{i}" for i in range(0, 25)]
+
+# test columns of T_FRUDSAB and their names after cleaning
+UDS_LABELS = helper.UDS_LABELS
+
+
+def _visit_grid(n_patients, visits, rng, keep=0.85):
+    """
+    Long (patient, visit) grid where every patient attends up to a random last visit
+    and misses some visits before it, like the attendance in the study.
+    """
+    last = rng.geometric(0.06, size=n_patients).clip(max=len(visits)) - 1
+    patients = np.repeat(np.arange(1, n_patients + 1), len(visits))
+    position = np.tile(np.arange(len(visits)), n_patients)
+    attended = (position <= np.repeat(last, len(visits))) & ((position == 0) | (rng.random(len(position)) < keep))
+    return patients[attended], np.asarray(visits)[position[attended]]
+
+
+def _metadata(n_rows, rng, columns):
+    """
+    CRF metadata columns that are dropped by clean_df.
+    """
+    return {col: rng.integers(0, 10_000, size=n_rows) for col in columns}
+
+
+def synthetic_rsa(n_patients, rng):
+    """
+    Research session attendance, one row per patient and attended visit.
+    """
+    patients, visits = _visit_grid(n_patients, RSA_VISITS, rng)
+    n = len(patients)
+    return pd.DataFrame(
+        {
+            "PATIENTNUMBER": np.nan,
+            "SITE": np.nan,
+            "VISIT": visits,
+            "PATIENTID": np.nan,
+            **_metadata(n, rng, ["VISITID", "RSA002", "RSA003", "RSA002_DT"]),
+            "RSA001": np.where(rng.random(n) < 0.97, 1.0, 0.0),
+            "patdeid": patients,
+        }
+    )
+
+
+def synthetic_uds(n_patients, rng, n_metadata=45):
+    """
+    Urine drug screens, one row per patient and attended visit, with the nine drug classes coded
+    0 negative, 1 positive, 2 and -5 not tested or invalid, and nulls.
+    """
+    patients, visits = _visit_grid(n_patients, UDS_VISITS, rng)
+    n = len(patients)
+    tests = {
+        col: rng.choice([0.0, 1.0, 2.0, -5.0, np.nan], p=[0.6, 0.3, 0.02, 0.03, 0.05], size=n) for col in UDS_LABELS
+    }
+    return pd.DataFrame(
+        {
+            "VISIT": visits,
+            **_metadata(n, rng, [f"META{i:02d}" for i in range(n_metadata)]),
+            **tests,
+            "patdeid": patients,
+        }
+    )
+
+
+def synthetic_dos(n_patients, rng):
+    """
+    Daily dosing records, seven rows per patient and attended week, with the medication
+    (1 methadone, 2 buprenorphine) and the dose.
+    """
+    patients, visits = _visit_grid(n_patients, DOS_VISITS, rng)
+    patients, visits = np.repeat(patients, 7), np.repeat(visits, 7)
+    medication = rng.choice([1.0, 2.0], size=n_patients + 1)[patients]
+    dose = np.where(medication == 1.0, rng.normal(70, 25, len(patients)), rng.normal(16, 6, len(patients)))
+    return pd.DataFrame(
+        {
+            "VISIT": visits,
+            **_metadata(len(patients), rng, ["VISITID", "DOS001", "DOS003", "DOS004"]),
+            "DOS002": medication,
+            "DOS005": np.where(rng.random(len(patients)) < 0.9, dose.clip(min=0).round(), np.nan),
+            "patdeid": patients,
+        }
+    )
+
+
+def synthetic_features(n_patients, rng):
+    """
+    Wide modelling table in the 42_features layout.
+    """
+    drugs = ["oxycodone", "cocaine", "methamphetamine", "opiate300"]
+    surveys = ["cocaine", "oxycodone", "methamphetamine", "opiates"]
+    columns = {}
+    for week in range(0, 5):
+        for drug in drugs:
+            columns[f"test_{drug}_{week}"] = (rng.random(n_patients) < 0.4).astype(float)
+    for week in (0, 4):
+        for drug in surveys:
+            columns[f"survey_{drug}_{week}"] = rng.poisson(2, n_patients).astype(float)
+    methadone = rng.random(n_patients) < 0.5
+    for week in range(0, 5):
+        columns[f"meds_methadone_{week}"] = np.where(methadone, rng.normal(70, 25, n_patients).round(), 0.0)
+        columns[f"meds_buprenorphine_{week}"] = np.where(methadone, 0.0, rng.normal(16, 6, n_patients).round())
+    columns["cows_predose"] = rng.integers(0, 30, n_patients)
+    columns["cows_postdose"] = rng.integers(0, 20, n_patients)
+    columns["gender"] = rng.integers(0, 2, n_patients).astype(float)
+    columns["dropout"] = (rng.random(n_patients) < 0.45).astype(float)
+    return pd.DataFrame(columns)
+
+
+def synthetic_cohort(n_patients, seed=0):
+    """
+    Generate every synthetic table for a cohort of the given size.
+
+    Parameters:
+    n_patients (int): Number of patients.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    dict: The raw 'rsa', 'uds' and 'dos' tables and the wide 'features' table.
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        "rsa": synthetic_rsa(n_patients, rng),
+        "uds": synthetic_uds(n_patients, rng),
+        "dos": synthetic_dos(n_patients, rng),
+        "features": synthetic_features(n_patients, rng),
+    }
+
+
+def measure(func, *args, repeat=3, **kwargs):
+    """
+    Run a function repeat times for the wall time, keeping the best run, then once more
+    under tracemalloc for the peak memory allocated during the call.
+
+    Returns:
+    tuple: (result, seconds, peak memory in MB)
+    """
+    seconds = np.inf
+    # the reports the helpers print are not part of the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            seconds = min(seconds, time.perf_counter() - start)
+            del result
+
+        gc.collect()
+        tracemalloc.start()
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, seconds, peak / 1e6
+
+
+def _shape(obj):
+    shape = getattr(obj, "shape", ())
+    return (shape + (1, 1))[:2] if len(shape) < 2 else shape[:2]
+
+
+def benchmark_size(n_patients, seed=0, repeat=3):
+    """
+    Run the pipeline steps on one synthetic cohort and record every helper call.
+
+    Returns:
+    list: One dict per function with the size, time, memory and input/output shapes.
+    """
+    tables = synthetic_cohort(n_patients, seed)
+    records = []
+
+    def record(name, func, first, *args, **kwargs):
+        result, seconds, peak = measure(func, first, *args, repeat=repeat, **kwargs)
+        rows_in, cols_in = _shape(first[0] if isinstance(first, list) else first)
+        rows_out, cols_out = _shape(result)
+        records.append(
+            {
+                "function": name,
+                "n_patients": n_patients,
+                "seconds": round(seconds, 6),
+                "peak_mb": round(peak, 3),
+                "rows_in": rows_in,
+                "cols_in": cols_in,
+                "rows_out": rows_out,
+                "cols_out": cols_out,
+            }
+        )
+        print(f"{name:>18} {n_patients:>9} patients: {seconds:8.3f} s {peak:10.1f} MB")
+        return result
+
+    # attendance: clean and flatten
+    rsa = record("clean_df", helper.clean_df, tables["rsa"], ["patdeid", "VISIT", "RSA001"], {"RSA001": "rsa_week"})
+    rsa = rsa.drop_duplicates(subset=["patdeid", "VISIT"])
+    rsa_flat = record("flatten_dataframe", helper.flatten_dataframe, rsa, visits=list(range(0, 25)) + [28, 32])
+
+    # drug screens: clean, flatten, outcome metrics
+    uds = helper.clean_df(tables["uds"], ["patdeid", "VISIT"] + list(UDS_LABELS), UDS_LABELS)
+    record("fill_visits", helper.fill_visits, uds, "bfill", limit=2)
+    uds_flat = helper.flatten_dataframe(uds, 0, 24, 1).fillna(1)
+    tests = uds_flat.columns[1:]
+    uds_flat[tests] = uds_flat[tests].replace({-5: 1, 2: 1})
+    uds_feat = record("uds_features", helper.uds_features, uds_flat)
+
+    # dosing: clean, weekly totals, medication features
+    dos = helper.clean_df(tables["dos"], ["patdeid", "VISIT", "DOS002", "DOS005"], {"DOS002": "medication", "DOS005": "total_dose"})
+    record("dose_features", helper.dose_features, dos)
+    dos_agg = dos.groupby(["patdeid", "VISIT", "medication"], as_index=False)["total_dose"].sum()
+    dos_agg["avg_daily_dose"] = (dos_agg.pop("total_dose") / 7).round()
+    dos_agg = record("med_features", helper.med_features, dos_agg)
+    dos_flat = helper.flatten_dataframe(dos_agg, 0, 24, 1)
+
+    # merge the tables into the wide feature table
+    uds_feat = uds_feat[["patdeid", "TNT", "NTR", "CNT", "responder"]]
+    merged = record("merge_dfs", helper.merge_dfs, [rsa_flat, dos_flat, uds_flat, uds_feat])
+
+    # profiling, feature selection and evaluation on the modelling layout
+    features = tables["features"]
+    record("df_value_counts", helper.df_value_counts, merged)
+    record("feature_selection", helper.feature_selection, features, "test_", ["oxycodone", "cocaine", "opiate300"])
+    scores = np.random.default_rng(seed).random(len(features))
+    record("cindex", helper.cindex, features["dropout"].to_numpy(), scores)
+
+    return records
+
+
+# modules that must not be loaded by import helper, they are imported on first use
+HEAVY_MODULES = ["matplotlib", "seaborn", "lifelines", "sklearn", "shap", "scipy", "joblib"]
+
+IMPORT_SCRIPT = """
+import resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, *[m for m in {heavy} if m in sys.modules])
+"""
+
+
+def benchmark_import(module="helper", repeat=5):
+    """
+    Time the import of a module in fresh interpreters, keeping the best run, and check that
+    none of the heavy plotting and modelling libraries are imported with it. The memory is
+    the peak resident size of the interpreter after the import.
+
+    Returns:
+    dict: The record of the import, with the heavy modules that were loaded.
+    """
+    script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        runs.append((float(output[0]), int(output[1]), output[2:]))
+
+    seconds, peak, loaded = min(runs)
+    peak = peak * 1024  # ru_maxrss is in kilobytes
+    print(f"{'import ' + module:>18} {'':>18}: {seconds:8.3f} s {peak / 1e6:10.1f} MB")
+    if loaded:
+        print(f"import {module} loaded heavy modules: {', '.join(loaded)}")
+
+    return {
+        "function": f"import {module}",
+        "n_patients": 0,
+        "seconds": round(seconds, 6),
+        "peak_mb": round(peak / 1e6, 3),
+        "heavy_modules": " ".join(loaded),
+    }
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.05):
+    """
+    Compare a run against a baseline run, flagging functions that got slower or used more
+    memory than the tolerance allows.
+
+    Parameters:
+    results (pandas.DataFrame): The current run.
+    baseline (pandas.DataFrame): The baseline run.
+    tolerance (float): Allowed relative increase, 0.25 is 25%.
+    min_seconds (float): Calls faster than this in both runs are too noisy to flag on time.
+
+    Returns:
+    pandas.DataFrame: Time and memory ratios per function and size, with a 'regression' flag.
+    """
+    keys = ["function", "n_patients"]
+    both = results.merge(baseline, on=keys, suffixes=("", "_baseline"))
+    both["time_ratio"] = (both["seconds"] / both["seconds_baseline"]).round(3)
+    both["memory_ratio"] = (both["peak_mb"] / both["peak_mb_baseline"]).round(3)
+    slower = (both["time_ratio"] > 1 + tolerance) & (both[["seconds", "seconds_baseline"]].max(axis=1) >= min_seconds)
+    both["regression"] = slower | (both["memory_ratio"] > 1 + tolerance)
+    if "heavy_modules" in both.columns:
+        both["regression"] |= both["heavy_modules"].fillna("").astype(str).str.len() > 0
+    return both[keys + ["seconds", "seconds_baseline", "time_ratio", "peak_mb", "peak_mb_baseline", "memory_ratio", "regression"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the helper package on synthetic CTN-0027 cohorts.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="cohort sizes in patients")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per function, the best is kept")
+    parser.add_argument("--output", default="../benchmarks/results.csv", help="csv file for the results")
+    parser.add_argument("--baseline", help="csv file of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--profile", help="JSON lines file for the stage records of the helpers")
+    args = parser.parse_args()
+
+    if args.profile:
+        helper.enable_profiling(args.profile, memory=False)
+
+    records = [benchmark_import("helper", args.repeat)]
+    for n_patients in args.sizes:
+        records.extend(benchmark_size(n_patients, args.seed, args.repeat))
+    results = pd.DataFrame(records)
+
+    if args.profile:
+        helper.disable_profiling()
+        print(helper.profile_summary().to_string())
+
+    if args.baseline:
+        report = compare(results, pd.read_csv(args.baseline), args.tolerance)
+        print(report.to_string(index=False))
+        if report["regression"].any():
+            print("Regressions found:", ", ".join(report.loc[report["regression"], "function"].unique()))
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        results.to_csv(args.output, index=False)
+        print("Results saved to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Helper functions of the CTN-0027 dropout project, split by stage:
+
+- helper.etl: loading, cleaning, reshaping and feature engineering of the tables
+- helper.metrics: concordance index and evaluation metrics
+- helper.modelling: imputation, hyperparameter search, model bundles, scoring and SHAP
+- helper.plotting: weekly charts and model plots
+- helper.store: memory-mapped, patdeid indexed feature store of the wide tables
+- helper.cache and helper.profiling: stage cache and instrumentation
+
+Every function is also available from the package itself, e.g. helper.clean_df. Only pandas
+and numpy are imported with the package; matplotlib, seaborn, lifelines, sklearn and shap are
+imported by the functions that use them, on first use.
+"""
+
+from .profiling import (
+    enable_profiling,
+    disable_profiling,
+    count_operation,
+    profile_stage,
+    profiled,
+    profile_summary,
+    profile_flame,
+)
+from .cache import (
+    CACHE_DIR,
+    file_digest,
+    stage_key,
+    evict_cache,
+    cached_stage,
+)
+from .store import (
+    write_feature_store,
+    FeatureStore,
+    open_feature_store,
+    load_features,
+)
+from .etl import (
+    clean_df,
+    decode_visit,
+    TABLE_SCHEMAS,
+    read_table,
+    read_table_chunks,
+    load_tables,
+    backfill_nulls,
+    fill_visits,
+    pivot_visits,
+    flatten_dataframe,
+    merge_dfs,
+    outcome_metrics,
+    stack_tests,
+    uds_features,
+    uds_panel_features,
+    feature_state,
+    update_feature_state,
+    feature_state_frame,
+    DOSE_MEDICATIONS,
+    DOSE_STATS,
+    med_features,
+    dose_features,
+    UDS_LABELS,
+    uds_transform,
+    plan_partitions,
+    partition_table,
+    stream_table,
+    EVENT_TABLES,
+    load_events,
+    event_vocabulary,
+    encode_events,
+    event_features,
+    column_index,
+    select_columns,
+    FEATURE_DTYPES,
+    feature_dtypes,
+    compact_dtypes,
+    profile_df,
+    profile_csv,
+    df_value_counts,
+    search_suffix,
+    feature_selection,
+)
+from .metrics import (
+    cindex,
+    batch_cindex,
+    bootstrap_cindex,
+    cindex_scorer,
+    threshold_sweep,
+)
+from .modelling import (
+    IMPUTATION_GROUPS,
+    fit_imputers,
+    imputation_report,
+    apply_imputers,
+    save_imputers,
+    load_imputers,
+    save_model_bundle,
+    load_model_bundle,
+    score_rows,
+    search_hyperparams,
+    LANDMARKS,
+    landmark_matrix,
+    train_landmarks,
+    model_digest,
+    explain_model,
+    patient_explanation,
+    dependence_slice,
+    feature_clustering,
+)
+from .plotting import (
+    series_func,
+    plot_func,
+    draw_weekly,
+    plot_weekly_data,
+    weekly_table,
+    agg_weekly_data,
+    render_weekly_report,
+    plot_confusion_matrix,
+    plot_feature_importance,
+    plot_dependence,
+)
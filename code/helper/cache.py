@@ -0,0 +1,249 @@
+"""
+Content-addressed cache of ETL stage outputs.
+"""
+
+import hashlib
+import inspect
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# directory for cached ETL stage outputs, relative to the notebooks in code/
+CACHE_DIR = "../cache"
+
+
+# digests of input files, keyed by path, size and modification time
+_file_digests = {}
+
+
+def file_digest(path):
+    """
+    Hash the contents of a file with sha256, reading it in chunks. Digests are remembered
+    for the session until the file's size or modification time changes.
+
+    Parameters:
+    path (str): Path to the file.
+
+    Returns:
+    str: The hex digest of the file contents.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def _update_digest(digest, value):
+    """
+    Feed a stage argument into a hash, hashing dataframes and arrays by content.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        digest.update(repr(list(zip(frame.columns, frame.dtypes.astype(str)))).encode())
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    elif hasattr(value, "tocsr"):
+        # scipy sparse matrices, e.g. one hot encoded features
+        value = value.tocsr()
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        for part in (value.data, value.indices, value.indptr):
+            digest.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(type(value).__name__.encode())
+        for item in value:
+            _update_digest(digest, item)
+    elif isinstance(value, dict):
+        digest.update(b"dict")
+        for k in sorted(value, key=repr):
+            _update_digest(digest, k)
+            _update_digest(digest, value[k])
+    elif isinstance(value, (set, frozenset)):
+        # the iteration order of a set changes between sessions
+        digest.update(type(value).__name__.encode())
+        for item in sorted(value, key=repr):
+            _update_digest(digest, item)
+    elif inspect.isfunction(value) or inspect.ismethod(value) or inspect.isbuiltin(value):
+        digest.update(_code_digest(value).encode())
+    else:
+        text = repr(value)
+        if " at 0x" in text:
+            raise TypeError(
+                f"Can't build a stable cache key from {type(value).__name__}, its repr holds a memory address"
+            )
+        digest.update(text.encode())
+
+
+def _code_digest(func):
+    """
+    Hash the code a stage runs: the function's source, plus every module of the helper
+    package so editing a helper it delegates to also invalidates its outputs, or the
+    version of the library it comes from.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{func.__module__}.{func.__qualname__}".encode())
+    try:
+        digest.update(inspect.getsource(func).encode())
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        digest.update(code.co_code if code is not None else b"")
+
+    package = (func.__module__ or "").split(".")[0]
+    if package == __name__.split(".")[0]:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".py"):
+                digest.update(file_digest(os.path.join(directory, name)).encode())
+    else:
+        import sys
+
+        digest.update(str(getattr(sys.modules.get(package), "__version__", "")).encode())
+
+    return digest.hexdigest()
+
+
+def stage_key(func, args, kwargs, files=()):
+    """
+    Build the cache key for a stage from the function code, its arguments and the
+    contents of its input files. Arguments are hashed by content, arguments without a
+    stable representation raise a TypeError.
+
+    Parameters:
+    func (callable): The stage function.
+    args (tuple): Positional arguments of the call.
+    kwargs (dict): Keyword arguments of the call.
+    files (list): Paths of the input files the stage reads.
+
+    Returns:
+    str: The hex digest identifying the stage output.
+    """
+    digest = hashlib.sha256()
+
+    # the function code and the helper modules, so editing a helper invalidates its outputs
+    digest.update(_code_digest(func).encode())
+
+    _update_digest(digest, list(args))
+    _update_digest(digest, kwargs)
+    for path in files:
+        digest.update(file_digest(path).encode())
+
+    return digest.hexdigest()
+
+
+def evict_cache(cache_dir=CACHE_DIR, max_bytes=None, max_age=None):
+    """
+    Evict cached stage outputs, first everything older than max_age, then the least
+    recently used files until the cache fits in max_bytes.
+
+    Parameters:
+    cache_dir (str): The cache directory.
+    max_bytes (int, optional): Maximum total size of the cache in bytes.
+    max_age (float, optional): Maximum age of a cached output in seconds since its last use.
+
+    Returns:
+    list: The paths of the evicted files.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    # least recently used first, the modification time is refreshed on every cache hit
+    entries.sort()
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+
+    evicted = []
+    for used, size, path in entries:
+        too_old = max_age is not None and now - used > max_age
+        too_big = max_bytes is not None and total > max_bytes
+        if too_old or too_big:
+            os.remove(path)
+            total -= size
+            evicted.append(path)
+
+    return evicted
+
+
+def _write_atomic(write, path):
+    """
+    Write a file next to its target and move it into place, so a reader never loads a
+    partially written output. The temporary file is removed when the write fails.
+    """
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path) or ".")
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def cached_stage(func, *args, files=(), cache_dir=CACHE_DIR, max_bytes=None, max_age=None, **kwargs):
+    """
+    Run an ETL stage through the on-disk cache. The output is keyed on the function code and
+    the helper modules, the arguments (dataframes are hashed by content) and the contents of
+    the input files, so a stage is only recomputed when something upstream of it changed.
+    Dataframes are stored as parquet, falling back to pickle when pyarrow is not installed or
+    a column cannot be stored. Outputs are written to a temporary file and moved into place.
+
+    Example:
+    rsa = cached_stage(pd.read_csv, "../unlabeled_data/T_FRRSA.csv", files=["../unlabeled_data/T_FRRSA.csv"])
+    rsa = cached_stage(clean_df, rsa, rsa_cols, rsa_labels)
+    rsa_flat = cached_stage(flatten_dataframe, rsa, visits=visits)
+
+    Parameters:
+    func (callable): The stage function, e.g. clean_df or flatten_dataframe.
+    *args: Positional arguments for func.
+    files (list): Paths of the input files the stage reads.
+    cache_dir (str): The cache directory.
+    max_bytes (int, optional): Evict least recently used outputs above this cache size.
+    max_age (float, optional): Evict outputs unused for longer than this many seconds.
+    **kwargs: Keyword arguments for func.
+
+    Returns:
+    The output of func, computed or loaded from the cache.
+    """
+    key = stage_key(func, args, kwargs, files)
+    stem = os.path.join(cache_dir, f"{func.__name__}-{key[:20]}")
+
+    # cache hit, refresh the last use time for eviction
+    for ext, read in ((".parquet", pd.read_parquet), (".pkl", pd.read_pickle)):
+        if os.path.exists(stem + ext):
+            os.utime(stem + ext)
+            return read(stem + ext)
+
+    result = func(*args, **kwargs)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stored = False
+    if isinstance(result, pd.DataFrame):
+        try:
+            _write_atomic(lambda path: result.to_parquet(path), stem + ".parquet")
+            stored = True
+        except (ImportError, ValueError, TypeError, NotImplementedError):
+            pass
+    if not stored:
+        _write_atomic(lambda path: pd.to_pickle(result, path), stem + ".pkl")
+
+    if max_bytes is not None or max_age is not None:
+        evict_cache(cache_dir, max_bytes, max_age)
+
+    return result
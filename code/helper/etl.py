@@ -0,0 +1,1601 @@
+"""
+Loading, cleaning, reshaping and feature engineering of the CTN-0027 tables.
+"""
+
+import functools
+import os
+import re
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from .profiling import count_operation, profiled
+from .store import write_feature_store
+
+
+# clean df function
+@profiled
+def clean_df(df, keep_cols, rename_cols):
+    """
+    Clean the given DataFrame by dropping unnecessary columns, renaming columns, and reordering columns.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to be cleaned.
+    keep_cols (list): A list of column names to keep in the DataFrame.
+    rename_cols (dict): A dictionary mapping old column names to new column names.
+
+    Returns:
+    pandas.DataFrame: The cleaned DataFrame.
+    """
+    # drop columns that are not on keep_cols list
+    df = df.drop(columns=[col for col in df.columns if col not in keep_cols])
+
+    # cleans the VISIT column, removing text and converting to integers for ordinal value
+    if "VISIT" in df.columns:
+        df["VISIT"] = decode_visit(df["VISIT"])
+    else:
+        pass
+
+    # rename columns
+    df = df.rename(columns=rename_cols)
+
+    # bring 'patdeid' column to 0 index at axis=1
+    df = pd.concat([df["patdeid"], df.drop(columns="patdeid")], axis=1)
+
+    return df
+
+
+def decode_visit(visit):
+    """
+    Decode the VISIT labels into integers for ordinal value, e.g. 'BASELINE' -> 0 and 'WK12' -> 12.
+    Only the distinct labels are parsed, each row is then mapped through the decoded labels.
+    Columns that are already numeric are returned as int.
+
+    Parameters:
+    visit (pandas.Series): The VISIT column, without missing values.
+
+    Returns:
+    pandas.Series: The visit number as int.
+    """
+    if visit.isna().any():
+        raise ValueError(f"Missing VISIT in {int(visit.isna().sum())} rows, drop or fill them before decoding")
+
+    if pd.api.types.is_numeric_dtype(visit):
+        return visit.astype(int)
+
+    visit = visit.astype("category")
+
+    # remove 'VISIT' and 'WK' from the labels, BASELINE is week 0
+    labels = (
+        visit.cat.categories.astype(str)
+        .str.replace("VISIT", "")
+        .str.replace("BASELINE", "0")
+        .str.replace("WK", "")
+        .astype(int)
+    )
+
+    return pd.Series(labels.to_numpy()[visit.cat.codes.to_numpy()], index=visit.index, name=visit.name)
+
+
+# columns and dtypes to read for each CTN-0027 table used in the project
+# test results and attendance are read as Int8 and coded answers as Int16, nullable so the nulls
+# survive parsing, doses as float32
+TABLE_SCHEMAS = {
+    "rsa": ("T_FRRSA.csv", {"patdeid": "int32", "VISIT": "category", "RSA001": "Int8"}),
+    "uds": (
+        "T_FRUDSAB.csv",
+        {"patdeid": "int32", "VISIT": "category", **{f"UDS{i:03d}": "Int8" for i in range(5, 14)}},
+    ),
+    "dsm": (
+        "T_FRDSM.csv",
+        {"patdeid": "int32", **{col: "Int16" for col in ["DSMOPI", "DSMAL", "DSMAM", "DSMCA", "DSMCO", "DSMSE"]}},
+    ),
+    "mdh": (
+        "T_FRMDH.csv",
+        {
+            "patdeid": "int32",
+            **{col: "Int16" for col in [f"MDH{i:03d}" for i in range(1, 18) if i != 11] + ["MDH011A", "MDH011B"]},
+        },
+    ),
+    "pex": (
+        "T_FRPEX.csv",
+        {
+            "patdeid": "int32",
+            "VISIT": "category",
+            **{col: "Int16" for col in ["PEX001A", "PEX003A", "PEX004A", "PEX006A", "PEX008A", "PEX011A"]},
+        },
+    ),
+    "tfb": (
+        "T_FRTFB.csv",
+        {"patdeid": "int32", "VISIT": "category", **{f"TFB{i:03d}A": "Int16" for i in range(1, 11)}},
+    ),
+    "dos": ("T_FRDOS.csv", {"patdeid": "int32", "VISIT": "category", "DOS002": "Int8", "DOS005": "float32"}),
+    "cw1": ("T_FRCOWS.csv", {"patdeid": "int32", "COWS012": "Int16"}),
+    "cw2": ("T_FRCOWS2.csv", {"patdeid": "int32", "COWS012": "Int16"}),
+    "rbs": (
+        "T_FRRBS0A.csv",
+        {"patdeid": "int32", **{col: "Int16" for col in ["RBS0B1", "RBS0A2C", "RBS0A2D", "RBS0A2E", "RBS0A3B"]}},
+    ),
+    "dem": ("T_FRDEM.csv", {"patdeid": "int32", "DEM002": "Int8"}),
+}
+
+
+def _read_options(columns):
+    # nullable integers parse much slower than floats, so they are parsed as float32 and cast after
+    nullable = {col: dtype for col, dtype in columns.items() if str(dtype).startswith(("Int", "UInt"))}
+    parse = {col: "float32" if col in nullable else dtype for col, dtype in columns.items()}
+
+    # columns missing from the file are skipped, as in clean_df
+    return nullable, {"usecols": lambda col: col in columns, "dtype": parse}
+
+
+def _finish_table(df, nullable, columns):
+    # put the columns in schema order, cast the nullable integer columns and decode the visits
+    df = df[[col for col in columns if col in df.columns]]
+    df = df.astype({col: dtype for col, dtype in nullable.items() if col in df.columns})
+
+    if "VISIT" in df.columns:
+        df["VISIT"] = decode_visit(df["VISIT"])
+
+    return df
+
+
+@profiled
+def read_table(path, columns, nrows=None):
+    """
+    Read a table, parsing only the given columns with their declared dtypes, in the order of
+    the schema. The VISIT column is decoded into integers while loading.
+
+    Parameters:
+    path (str): Path to the csv file.
+    columns (dict): Mapping of the columns to keep to their dtypes.
+    nrows (int, optional): Only read the first rows.
+
+    Returns:
+    pandas.DataFrame: The table with the kept columns.
+    """
+    nullable, options = _read_options(columns)
+    return _finish_table(pd.read_csv(path, nrows=nrows, **options), nullable, columns)
+
+
+def read_table_chunks(path, columns, chunksize=100_000):
+    """
+    Read a table in chunks of rows, each chunk parsed as in read_table.
+
+    Yields:
+    pandas.DataFrame: The next chunk with the kept columns.
+    """
+    nullable, options = _read_options(columns)
+    with pd.read_csv(path, chunksize=chunksize, **options) as reader:
+        for chunk in reader:
+            yield _finish_table(chunk, nullable, columns)
+
+
+@profiled
+def load_tables(schemas=TABLE_SCHEMAS, data_path="../unlabeled_data/", max_workers=None):
+    """
+    Load the tables concurrently, each one reading only its schema columns.
+
+    Parameters:
+    schemas (dict): Mapping of table names to (file name, {column: dtype}).
+    data_path (str): Directory of the csv files.
+    max_workers (int, optional): Number of threads, defaults to one per table.
+
+    Returns:
+    dict: Mapping of table names to DataFrames.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(schemas)) as pool:
+        futures = {
+            name: pool.submit(read_table, os.path.join(data_path, file_name), columns)
+            for name, (file_name, columns) in schemas.items()
+        }
+        tables = {name: future.result() for name, future in futures.items()}
+
+    for name, df in tables.items():
+        print(f"{name} shape: {df.shape}")
+
+    return tables
+
+
+@profiled
+def backfill_nulls(df, cols, by="patdeid"):
+    """
+    Backfill null values in the given columns with the next non-null value of the same patient.
+    Tables without the patient column are backfilled over the whole frame.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to be cleaned.
+    cols (list): A list of column names to backfill.
+    by (str): The patient column, values never leak from one patient to another.
+
+    Returns:
+    pandas.DataFrame: The cleaned DataFrame.
+    """
+    if by in df.columns:
+        df[cols] = fill_visits(df, "bfill", columns=cols, by=by)[cols]
+    else:
+        df[cols] = df[cols].bfill()
+    return df
+
+
+def _fill_positions(valid, group, strategy, limit=None):
+    """
+    Row position each cell is filled from, for a (columns x rows) notnull mask of rows sorted
+    by group and visit, -1 where there is no value to fill from within the group and limit.
+    """
+    n = valid.shape[1]
+    rows = np.arange(n, dtype=np.int32 if n < 2**31 - 1 else np.int64)
+    new_group = np.r_[True, group[1:] != group[:-1]]
+    if strategy == "ffill":
+        # last valid row at or before each row, invalid when it falls in an earlier group
+        pos = np.maximum.accumulate(np.where(valid, rows, -1), axis=1)
+        bound = rows[new_group][np.cumsum(new_group) - 1]
+        ok = pos >= bound
+        if limit is not None:
+            ok &= rows - pos <= limit
+    else:
+        # next valid row at or after each row, invalid when it falls in a later group
+        pos = np.minimum.accumulate(np.where(valid, rows, n)[:, ::-1], axis=1)[:, ::-1]
+        bound = rows[np.r_[new_group[1:], True]][np.cumsum(new_group) - 1]
+        ok = pos <= bound
+        if limit is not None:
+            ok &= pos - rows <= limit
+
+    return np.where(ok, pos, -1)
+
+
+@profiled
+def fill_visits(df, strategy="bfill", columns=None, limit=None, by="patdeid", order="VISIT"):
+    """
+    Fill null values within each patient, in visit order, for many columns in one vectorized
+    pass. The table is sorted once, the row every cell is filled from is found with a running
+    maximum (ffill) or minimum (bfill) of the valid row positions over all columns at once, and
+    fills never cross from one patient to another. Column dtypes are kept.
+
+    Parameters:
+    df (pandas.DataFrame): Long table with one row per patient and visit, e.g. T_FRUDSAB.
+    strategy (str or dict): 'bfill' or 'ffill' for every column, or a dict of column to
+    strategy, e.g. {'test_cocaine': 'ffill', 'test_opiate300': 'bfill'}.
+    columns (list, optional): Columns to fill, the dict keys or every other column by default.
+    limit (int, optional): Maximum number of consecutive visits filled from one value.
+    by (str): The patient column.
+    order (str, optional): The visit column the rows are ordered by within a patient, None keeps
+    the row order.
+
+    Returns:
+    pandas.DataFrame: A copy of the table with the columns filled, in the original row order.
+    """
+    if isinstance(strategy, dict):
+        columns = list(strategy) if columns is None else columns
+        strategies = {col: strategy.get(col, "bfill") for col in columns}
+    else:
+        columns = [col for col in df.columns if col not in (by, order)] if columns is None else columns
+        strategies = {col: strategy for col in columns}
+    if set(strategies.values()) - {"bfill", "ffill"}:
+        raise ValueError("strategy must be 'bfill' or 'ffill'")
+
+    # group rows by patient in order of appearance and by visit within a patient; exports
+    # are usually sorted already, then the sort is skipped
+    group = pd.factorize(df[by])[0].astype(np.int64)
+    key = group
+    if order is not None:
+        visit, visits = pd.factorize(df[order], sort=True)
+        key = group * len(visits) + visit
+    # ties are broken by the row position, so the faster unstable sort keeps the row order
+    sort = None if (np.diff(key) >= 0).all() else np.argsort(key * len(key) + np.arange(len(key)))
+    if sort is not None:
+        group = group[sort]
+
+    df = df.copy()
+    for method in ("bfill", "ffill"):
+        cols = [col for col in columns if strategies[col] == method]
+        if not cols:
+            continue
+
+        # one notnull mask and one array of source rows for all the columns of this strategy,
+        # laid out column by column so the running max/min scans contiguous memory
+        valid = np.ascontiguousarray(df[cols].notna().to_numpy().T)
+        pos = _fill_positions(valid if sort is None else valid[:, sort], group, method, limit)
+        if sort is not None:
+            source = np.empty_like(pos)
+            source[:, sort] = np.where(pos >= 0, sort[np.maximum(pos, 0)], -1)
+        else:
+            source = pos
+
+        for j, col in enumerate(cols):
+            if valid[j].all():
+                continue
+            values = df[col].to_numpy() if isinstance(df[col].dtype, np.dtype) else df[col].array
+            df[col] = pd.api.extensions.take(values, source[j], allow_fill=True)
+
+    return df
+
+
+def _nullable(values):
+    """
+    Convert numpy integer and boolean columns to the nullable pandas dtype of the same size,
+    so missing values can be added without upcasting to float64.
+    """
+    if isinstance(values, pd.DataFrame):
+        return values.astype({col: _nullable(values[col]).dtype for col in values.columns})
+
+    dtype = values.dtype
+    if isinstance(dtype, np.dtype) and dtype.kind in "iu":
+        return values.astype(f"{'U' if dtype.kind == 'u' else ''}Int{dtype.itemsize * 8}")
+    if isinstance(dtype, np.dtype) and dtype.kind == "b":
+        return values.astype("boolean")
+    return values
+
+
+@profiled
+def pivot_visits(df, visits, anchor=None):
+    """
+    Reshape a long visit table (one row per patient per visit) into a wide table with
+    one row per patient, in a single pass and without any intermediate dataframes.
+    A (patients x visits) array of row positions is built from the position of the patient
+    and the position of the visit in the schedule, and every wide column is taken from the
+    long table through it, so the cost grows linearly with the number of rows. Column dtypes
+    are kept, integer and boolean columns become nullable where a visit is missing.
+
+    Columns are named col_week and ordered week by week, e.g. for the schedule [0, 1]:
+    patdeid, rsa_week_0, rsa_week_1.  Duplicate patient/visit rows keep the first record
+    and visits that are not on the schedule are ignored.
+
+    Parameters:
+    df (pandas.DataFrame): Long table with 'patdeid', 'VISIT' and the value columns.
+    visits (list): The visit schedule, e.g. [0, 1, 2, 3, 4, 28, 32].
+    anchor (int, optional): Only keep patients with a record at this visit. The default
+    keeps every patient found in the table.
+
+    Returns:
+    pandas.DataFrame: The wide dataframe, one row per patient.
+    """
+    visits = list(visits)
+    value_cols = [col for col in df.columns if col not in ("patdeid", "VISIT")]
+
+    # position of each row's visit in the schedule, -1 when the visit is not scheduled
+    week_pos = pd.Index(visits).get_indexer(df["VISIT"])
+
+    # keep the first record for every patient and visit on the schedule
+    keep = (week_pos >= 0) & ~df.duplicated(subset=["patdeid", "VISIT"]).to_numpy()
+
+    # patient codes in order of first appearance
+    pat_codes, patients = pd.factorize(df["patdeid"])
+    pat_codes, week_pos = pat_codes[keep], week_pos[keep]
+
+    # row of the long table feeding each (patient, visit) cell, -1 when there is no record
+    source = np.full((len(patients), len(visits)), -1)
+    source[pat_codes, week_pos] = np.flatnonzero(keep)
+
+    # restrict to patients seen at the anchor visit, in the order they appear at that visit
+    if anchor is not None:
+        patients = patients[pat_codes[week_pos == visits.index(anchor)]]
+        source = source[pat_codes[week_pos == visits.index(anchor)]]
+
+    # take each value column into the wide layout, missing cells become null without
+    # changing the dtype (integer and boolean columns become their nullable version)
+    arrays = {col: _nullable(df[col]).values for col in value_cols}
+
+    # name the columns col_week, week by week
+    wide = {"patdeid": np.asarray(patients)}
+    for j, week in enumerate(visits):
+        for col in value_cols:
+            wide[f"{col}_{week}"] = pd.api.extensions.take(arrays[col], source[:, j], allow_fill=True)
+
+    df = pd.DataFrame(wide)
+    count_operation("pivots")
+
+    return df
+
+
+@profiled
+def flatten_dataframe(df, start=None, stop=None, step=1, visits=None):
+    """
+    Flattens a dataframe by pivoting every week of clinical data into columns annotated with
+    the corresponding week number, reshaping dataframe to 1 row per patient, with all clinical
+    data properly encoded into columns.
+
+    Args:
+        df (pandas.DataFrame): The input dataframe.
+        start (int): The starting week number.
+        stop (int): The stopping week number.
+        step (int): The step size between weeks.
+        visits (list, optional): Explicit visit schedule, e.g. [0, 1, ..., 24, 28, 32].
+            Overrides start, stop and step, so no columns are created for weeks without visits.
+
+    Returns:
+        pandas.DataFrame: The flattened dataframe, with the patients that have a record
+        at the first week of the schedule.
+
+    """
+    # build the schedule from the range when no explicit schedule is given
+    if visits is None:
+        visits = list(range(start, stop + 1, step))
+
+    return pivot_visits(df, visits, anchor=visits[0])
+
+
+@profiled
+def merge_dfs(dfs, on_duplicate="first", store=None):
+    """
+    Merge the given list of DataFrames into one DataFrame, left joined on the patients of the
+    first DataFrame. Every DataFrame is indexed once by 'patdeid' and all of them are aligned
+    in a single concatenation, instead of a chain of pairwise merges.
+
+    Tables with more than one row per patient would blow up a merge one:many, so they are
+    checked before joining: either the first row per patient is kept with a warning naming
+    the tables, or the merge is rejected.
+
+    Unlike a chain of pd.merge calls, which suffixes overlapping columns with _x and _y,
+    a column found in more than one table raises a ValueError; rename or drop it first.
+
+    Parameters:
+    dfs (list): A list of DataFrames to be merged, each with a 'patdeid' column.
+    on_duplicate (str): 'first' keeps the first row per patient and warns, 'raise' raises a
+    ValueError.
+    store (str, optional): Also write the merged table to a feature store in this directory,
+    see helper.open_feature_store.
+
+    Returns:
+    pandas.DataFrame: The merged DataFrame, one row per patient.
+    """
+    if on_duplicate not in ("first", "raise"):
+        raise ValueError("on_duplicate must be 'first' or 'raise'")
+
+    frames = []
+    duplicates = {}
+    for i, df in enumerate(dfs):
+        df = df.set_index("patdeid")
+
+        # detect tables with more than one row per patient
+        dup = df.index.duplicated(keep="first")
+        if dup.any():
+            duplicates[i] = int(dup.sum())
+            df = df.loc[~dup]
+
+        frames.append(df)
+
+    if duplicates:
+        report = ", ".join(f"table {i}: {n} rows" for i, n in duplicates.items())
+        if on_duplicate == "raise":
+            raise ValueError(f"Non-unique patdeid keys found in {report}")
+        warnings.warn(f"Kept the first row per patient for non-unique patdeid keys in {report}", stacklevel=3)
+
+    # columns must be unique across tables, a merge would silently suffix them
+    columns = pd.Index([col for df in frames for col in df.columns])
+    if columns.has_duplicates:
+        overlap = sorted(set(columns[columns.duplicated()]))
+        raise ValueError(f"Columns found in more than one table: {overlap}")
+
+    # align every table on the patients of the first table and join in one pass
+    # tables missing some patients switch to nullable dtypes instead of float64
+    index = frames[0].index
+    aligned = [frames[0]]
+    for df in frames[1:]:
+        if not index.isin(df.index).all():
+            df = _nullable(df)
+        aligned.append(df.reindex(index))
+    df = pd.concat(aligned, axis=1).reset_index()
+    count_operation("merges")
+
+    if store is not None:
+        write_feature_store(df, store)
+
+    return df
+
+
+def outcome_metrics(tests, window=5):
+    """
+    Computes the outcome metrics for a matrix of weekly urine tests in a few vectorized
+    passes, where 0 is a negative test and anything else is positive. The last axis holds
+    the weeks, so a 2-D matrix is (patients x weeks) and a 3-D array is
+    (drugs x patients x weeks), which computes every drug class at once.
+
+    1) 'TNT' - Total Negative tests
+    2) 'NTR' - Negative Test Rate, TNT divided by the number of weeks
+    3) 'CNT' - longest streak of Consecutive Negative tests
+    4) 'responder' - 1 when every test in the final `window` weeks is negative
+
+    Parameters:
+    tests (numpy.ndarray): Test results with the weeks on the last axis, nulls already filled.
+    window (int): Number of final weeks in the abstinence window, 0 < window <= weeks.
+
+    Returns:
+    dict: Arrays for 'TNT', 'NTR', 'CNT' and 'responder', with the weeks axis removed.
+    """
+    negative = np.asarray(tests) == 0.0
+    weeks = negative.shape[-1]
+    if not 0 < window <= weeks:
+        raise ValueError(f"window must be between 1 and the number of weeks ({weeks}), got {window}")
+
+    # total negatives and negative rate
+    tnt = negative.sum(axis=-1)
+    ntr = tnt / weeks
+
+    # longest run of negatives: running count of negatives minus the count at the last positive
+    count = np.cumsum(negative, axis=-1)
+    reset = np.maximum.accumulate(np.where(negative, 0, count), axis=-1)
+    cnt = (count - reset).max(axis=-1) if weeks else np.zeros_like(tnt)
+
+    # responder: every test in the abstinence window is negative
+    responder = negative[..., weeks - window :].all(axis=-1).astype(int)
+
+    return {"TNT": tnt, "NTR": ntr, "CNT": cnt, "responder": responder}
+
+
+def stack_tests(df, drugs):
+    """
+    Stacks the weekly test columns (test_drug_week) for each drug into one
+    (drugs x patients x weeks) array, with the weeks sorted numerically.
+
+    Parameters:
+    df (pandas.DataFrame): Wide dataframe with 'patdeid' and the test columns.
+    drugs (list): Drug names, e.g. ['opiate300', 'cocaine'].
+
+    Returns:
+    numpy.ndarray: The stacked test results, nulls kept as NaN.
+    """
+    index = column_index(df)
+
+    blocks = []
+    for drug in drugs:
+        cols = index.loc[(index["source"] == "test") & (index["measure"] == drug) & index["week"].notna()]
+        cols = cols.sort_values("week").index
+        blocks.append(df[cols].to_numpy(dtype=float, na_value=np.nan))
+
+    return np.stack(blocks)
+
+
+@profiled
+def uds_features(df, drug="opiate300", window=5):
+    """
+    Creates metrics used to measure outcomes from test data for one drug class, opiates by default,
+    listed as follows:
+    1) 'TNT' - Total Negative tests - counts total negative tests per patient
+
+    2) 'CNT' - Consecutive Negative tests - counts number of consecutive weeks of negative tests
+
+    3) 'responder' - A responder is defined as a patient who successfully meets the abstinence window
+    with clean urine tests for the final weeks of treatment. The window of 5 weeks (weeks 20 - 24)
+    is the one the project labels were built with.
+
+    4) 'NTR' - Negative Test Rate - counts the number of negative tests per patient
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame containing the tests data.
+    drug (str): The drug class to measure, matching test_{drug}_{week} columns.
+    window (int): Number of final weeks in the abstinence window.
+
+    Returns:
+    pandas.DataFrame: The processed DataFrame.
+    """
+    # create df for the drug tests
+    tests = df.loc[:, ["patdeid"] + [col for col in df.columns if f"test_{drug}" in col]]
+
+    # null values will be treated as positive urine tests and filled with 1.0
+    tests = tests.fillna(1.0)
+
+    # compute the metrics for every patient at once
+    metrics = outcome_metrics(tests.iloc[:, 1:].to_numpy(dtype=float, na_value=1.0), window)
+    for name in ["TNT", "NTR", "CNT", "responder"]:
+        tests[name] = metrics[name].astype(FEATURE_DTYPES[name].lower())
+
+    return tests
+
+
+@profiled
+def uds_panel_features(df, drugs, window=5):
+    """
+    Creates the uds_features metrics for several drug classes in one pass over a
+    (drugs x patients x weeks) array. Columns are named metric_drug, e.g. 'TNT_cocaine'.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame containing the tests data.
+    drugs (list): Drug names, e.g. ['opiate300', 'cocaine', 'cannabinoid'].
+    window (int): Number of final weeks in the abstinence window.
+
+    Returns:
+    pandas.DataFrame: 'patdeid' and the four metrics for each drug.
+    """
+    # null values will be treated as positive urine tests and filled with 1.0
+    tests = np.nan_to_num(stack_tests(df, drugs), nan=1.0)
+
+    metrics = outcome_metrics(tests, window)
+
+    features = {"patdeid": df["patdeid"].to_numpy()}
+    for i, drug in enumerate(drugs):
+        for name in ["TNT", "NTR", "CNT", "responder"]:
+            features[f"{name}_{drug}"] = metrics[name][i].astype(FEATURE_DTYPES[name].lower())
+
+    return pd.DataFrame(features, index=df.index)
+
+
+def feature_state(drug="opiate300", visits=range(0, 25), window=5):
+    """
+    Create an empty incremental feature state, updated one visit record at a time with
+    update_feature_state instead of rebuilding the wide table in batch. The outcome metrics
+    follow uds_features: tests are negative when 0, and weeks without a result are positive.
+
+    Parameters:
+    drug (str): The drug class of the outcome metrics, matching 'test_{drug}' record fields.
+    visits (list): The visit schedule of the tests, NTR is TNT over the number of visits.
+    window (int): Number of final visits in the abstinence window.
+
+    Returns:
+    dict: The feature state, with one entry per patient under 'patients'.
+    """
+    visits = list(visits)
+    return {
+        "drug": drug,
+        "visits": {week: i for i, week in enumerate(visits)},
+        "window": set(visits[len(visits) - window :]),
+        "patients": {},
+    }
+
+
+def update_feature_state(state, record):
+    """
+    Add one visit record to the feature state and update the patient's features in constant time.
+
+    Every field of the record other than 'patdeid' and 'VISIT' is stored as field_week, e.g.
+    {'patdeid': 7, 'VISIT': 3, 'test_opiate300': 0, 'meds_methadone': 60, 'rsa_week': 1} sets
+    test_opiate300_3, meds_methadone_3 and rsa_week_3. A test of the outcome drug also updates
+    TNT, NTR, CNT and responder. The consecutive negative streak is extended in place while the
+    tests arrive in visit order, a late or corrected result rescans the patient's schedule.
+
+    Parameters:
+    state (dict): The feature state from feature_state.
+    record (dict): One visit record with 'patdeid', 'VISIT' and the feature values.
+
+    Returns:
+    dict: The patient's current features.
+    """
+    patient = state["patients"].setdefault(
+        record["patdeid"],
+        {
+            "features": {"patdeid": record["patdeid"], "TNT": 0, "NTR": 0.0, "CNT": 0, "responder": 0},
+            "negative": {},
+            "run": 0,
+            "last": None,
+            "window_negatives": 0,
+        },
+    )
+    features = patient["features"]
+    week = record["VISIT"]
+
+    for key, value in record.items():
+        if key not in ("patdeid", "VISIT"):
+            features[f"{key}_{week}"] = value
+
+    test = f"test_{state['drug']}"
+    if test not in record or week not in state["visits"]:
+        return features
+
+    # null and non-zero results are positive tests
+    value = record[test]
+    negative = not pd.isna(value) and bool(value == 0.0)
+    previous = patient["negative"].get(week, False)
+    patient["negative"][week] = negative
+
+    # total negatives and the abstinence window, adjusted for a corrected result
+    features["TNT"] += int(negative) - int(previous)
+    features["NTR"] = features["TNT"] / len(state["visits"])
+    if week in state["window"]:
+        patient["window_negatives"] += int(negative) - int(previous)
+    features["responder"] = int(patient["window_negatives"] == len(state["window"]))
+
+    position = state["visits"][week]
+    if patient["last"] is None or position > patient["last"]:
+        # next result in visit order, a skipped visit counts as a positive test
+        if patient["last"] is not None and position > patient["last"] + 1:
+            patient["run"] = 0
+        patient["run"] = patient["run"] + 1 if negative else 0
+        patient["last"] = position
+        features["CNT"] = max(features["CNT"], patient["run"])
+    else:
+        # late or corrected result, rescan the schedule up to the last visit
+        run = cnt = 0
+        for w, i in state["visits"].items():
+            if i > patient["last"]:
+                break
+            run = run + 1 if patient["negative"].get(w, False) else 0
+            cnt = max(cnt, run)
+        patient["run"] = run
+        features["CNT"] = cnt
+
+    return features
+
+
+def feature_state_frame(state, columns=None):
+    """
+    Collect the current features of every patient in the feature state into a wide dataframe.
+
+    Parameters:
+    state (dict): The feature state from feature_state.
+    columns (list, optional): Columns of the result, e.g. the model's feature schema;
+    missing features are null.
+
+    Returns:
+    pandas.DataFrame: One row per patient.
+    """
+    df = pd.DataFrame.from_records([patient["features"] for patient in state["patients"].values()])
+    if columns is not None:
+        df = df.reindex(columns=columns)
+    return df
+
+
+# medication codes of T_FRDOS (DOS002) and their feature names
+DOSE_MEDICATIONS = {1: "methadone", 2: "buprenorphine"}
+
+
+# weekly dose statistics and the suffixes of their columns, 'dose' is the average daily dose
+# over the 7 days of the week used by the project's features
+DOSE_STATS = {
+    "dose": "",
+    "mean": "_mean",
+    "max": "_max",
+    "cumulative": "_cumulative",
+    "days": "_days",
+    "changes": "_changes",
+}
+
+
+def _medication_name(code, medications=DOSE_MEDICATIONS):
+    # codes without a name are kept as med<code>
+    return medications.get(code, f"med{int(code)}")
+
+
+@profiled
+def med_features(df, medications=DOSE_MEDICATIONS):
+    """
+    Process the medication dataframe by creating a dose column per medication,
+    filling null values with 0, and dropping unnecessary columns.
+
+    Parameters:
+    df (pandas.DataFrame): The medication dataframe.
+    medications (dict): Medication codes and their names, codes without a name become med<code>.
+
+    Returns:
+    pandas.DataFrame: The processed dataframe.
+    """
+    codes = sorted(set(medications) | set(df["medication"].dropna().unique()))
+
+    # create a dose column per medication, 0 for the other medications
+    # the dose keeps its dtype instead of passing through a null and float64
+    for code in codes:
+        df[f"meds_{_medication_name(code, medications)}"] = df["avg_daily_dose"].where(df.medication == code, 0).fillna(0)
+
+    # drop original columns to remove redundancy
+    df = df.drop(columns=["avg_daily_dose", "medication"])
+
+    return df
+
+
+@profiled
+def dose_features(df, stats=tuple(DOSE_STATS), medications=DOSE_MEDICATIONS, dose="total_dose"):
+    """
+    Weekly dose features per patient and medication from the daily dosing records, in one
+    grouped pass. Every statistic is computed for every medication code found in the table,
+    and the result has one row per patient and week, ready for flatten_dataframe.
+
+    Statistics (see DOSE_STATS), with columns named meds_{medication}{suffix}:
+    'dose' - average daily dose over the 7 days of the week, the meds_methadone/meds_buprenorphine
+    features of med_features
+    'mean' - mean of the recorded doses
+    'max' - largest dose
+    'cumulative' - total dose from the first week up to this week
+    'days' - days with a dose above 0
+    'changes' - number of times the dose changed from one record to the next within the week
+
+    Weeks without a record of a medication are 0 for that medication. The features have the
+    dose dtype of FEATURE_DTYPES.
+
+    Parameters:
+    df (pandas.DataFrame): Cleaned T_FRDOS rows with 'patdeid', 'VISIT', 'medication' and the dose,
+    in the order they were recorded.
+    stats (list): Statistics to compute.
+    medications (dict): Medication codes and their names, codes without a name become med<code>.
+    dose (str): The daily dose column.
+
+    Returns:
+    pandas.DataFrame: 'patdeid', 'VISIT' and the dose features.
+    """
+    unknown = set(stats) - set(DOSE_STATS)
+    if unknown:
+        raise ValueError(f"unknown dose statistics: {sorted(unknown)}")
+
+    df = df.dropna(subset=["patdeid", "VISIT", "medication"])
+
+    # codes of the patients, weeks and medications, and one sort key combining them; the sort
+    # is skipped when the records are already in order, ties keep the order of the records
+    patient, patients = pd.factorize(df["patdeid"], sort=True)
+    week, weeks = pd.factorize(df["VISIT"], sort=True)
+    med, meds = pd.factorize(df["medication"], sort=True)
+    key = (patient.astype(np.int64) * len(weeks) + week) * len(meds) + med
+    if not (np.diff(key) >= 0).all():
+        order = np.argsort(key * len(key) + np.arange(len(key)))
+        key, patient, week, med = key[order], patient[order], week[order], med[order]
+        values = df[dose].to_numpy(dtype=float)[order]
+    else:
+        values = df[dose].to_numpy(dtype=float)
+
+    # groups of records of one patient, week and medication, and rows of one patient and week
+    first = np.r_[True, key[1:] != key[:-1]]
+    starts = np.flatnonzero(first)
+    new_row = np.r_[True, (key // len(meds))[1:] != (key // len(meds))[:-1]]
+    row = np.cumsum(new_row)[starts] - 1
+    col = med[starts]
+
+    # sums over the records of each group, nulls count as 0, only for the requested statistics
+    recorded = ~np.isnan(values)
+    doses = np.where(recorded, values, 0.0)
+    total = np.add.reduceat(doses, starts)
+    weekly = {}
+    if "dose" in stats:
+        weekly["dose"] = np.round(total / 7)
+    if "mean" in stats:
+        count = np.add.reduceat(recorded.astype(np.int64), starts)
+        weekly["mean"] = np.divide(total, count, out=np.zeros(len(total)), where=count > 0)
+    if "max" in stats:
+        weekly["max"] = np.nan_to_num(np.fmax.reduceat(values, starts))
+    if "days" in stats:
+        weekly["days"] = np.add.reduceat((doses > 0).astype(np.int64), starts)
+    if "changes" in stats:
+        previous = np.r_[np.nan, values[:-1]]
+        changed = ~first & recorded & ~np.isnan(previous) & (values != previous)
+        weekly["changes"] = np.add.reduceat(changed.astype(np.int64), starts)
+
+    # lay the groups out as (rows x medications), weeks without a record of a medication are 0
+    n_rows = row[-1] + 1 if len(row) else 0
+    layout = {}
+    for stat in stats:
+        if stat == "cumulative":
+            continue
+        layout[stat] = np.zeros((n_rows, len(meds)), dtype=weekly[stat].dtype)
+        layout[stat][row, col] = weekly[stat]
+
+    # running total per patient and medication, restarted at the first week of each patient
+    row_patient = patient[np.flatnonzero(new_row)]
+    if "cumulative" in stats:
+        totals = np.zeros((n_rows, len(meds)))
+        totals[row, col] = total
+        running = np.cumsum(totals, axis=0)
+        patient_start = np.flatnonzero(np.r_[True, row_patient[1:] != row_patient[:-1]])
+        before = np.vstack([np.zeros((1, len(meds))), running[patient_start[1:] - 1]])
+        layout["cumulative"] = running - np.repeat(before, np.diff(np.r_[patient_start, n_rows]), axis=0)
+
+    # name the columns meds_{medication}{suffix}, medication by medication, and add the
+    # named medications that have no records; every statistic has the dose dtype of the schema
+    dtype = FEATURE_DTYPES["meds"].lower()
+    wide = {
+        "patdeid": patients.to_numpy()[row_patient],
+        "VISIT": weeks.to_numpy()[week[np.flatnonzero(new_row)]],
+    }
+    codes = sorted(set(medications) | set(meds))
+    for code in codes:
+        j = meds.get_loc(code) if code in meds else None
+        for stat in stats:
+            name = f"meds_{_medication_name(code, medications)}{DOSE_STATS[stat]}"
+            wide[name] = layout[stat][:, j].astype(dtype) if j is not None else np.zeros(n_rows, dtype=dtype)
+
+    return pd.DataFrame(wide)
+
+
+# test columns of T_FRUDSAB and their names after cleaning
+UDS_LABELS = {
+    "UDS005": "test_amphetamines",
+    "UDS006": "test_benzodiazepine",
+    "UDS007": "test_mmethadone",
+    "UDS008": "test_oxycodone",
+    "UDS009": "test_cocaine",
+    "UDS010": "test_methamphetamine",
+    "UDS011": "test_opiate300",
+    "UDS012": "test_cannabinoid",
+    "UDS013": "test_propoxyphene",
+}
+
+
+def uds_transform(df, drug="opiate300", window=5):
+    """
+    The drug screen steps of the transformation notebook for one table or one partition of
+    patients: rename, flatten weeks 0 to 24, treat missing, invalid and untested screens as
+    positive, and add the outcome metrics.
+
+    Parameters:
+    df (pandas.DataFrame): Long T_FRUDSAB rows with 'patdeid', 'VISIT' and the UDS columns.
+    drug (str): The drug class of the outcome metrics.
+    window (int): Number of final weeks in the abstinence window.
+
+    Returns:
+    pandas.DataFrame: The flattened tests with 'TNT', 'NTR', 'CNT' and 'responder', one row per patient.
+    """
+    df = df.rename(columns=UDS_LABELS)
+
+    # flatten weekly screens, missing screens are positive
+    flat = flatten_dataframe(df, 0, 24, 1).fillna(1)
+    tests = flat.columns[1:]
+    flat[tests] = flat[tests].replace({-5: 1, 2: 1})
+
+    metrics = uds_features(flat, drug, window)[["patdeid", "TNT", "NTR", "CNT", "responder"]]
+    return pd.concat([flat, metrics.iloc[:, 1:]], axis=1)
+
+
+def plan_partitions(path, columns, max_memory_mb=512, max_workers=1, expansion=8, sample_rows=10_000):
+    """
+    Size the chunks and the patient partitions of a streaming run so every worker stays within
+    its share of the memory cap. The parsed size of a row and the number of rows in the file
+    are estimated from a sample of its first lines.
+
+    Parameters:
+    path (str): Path to the csv file.
+    columns (dict): Mapping of the columns to keep to their dtypes.
+    max_memory_mb (int): Memory cap of the whole run.
+    max_workers (int): Number of partitions transformed at once.
+    expansion (int): Peak memory of transforming a partition, as a multiple of its parsed size.
+    sample_rows (int): Rows sampled for the estimates.
+
+    Returns:
+    dict: 'chunksize' rows read at a time, 'n_partitions', and the estimated 'rows' and 'row_bytes'.
+    """
+    sample = read_table(path, columns, nrows=sample_rows)
+    row_bytes = max(sample.memory_usage(deep=True).sum() / max(len(sample), 1), 1.0)
+
+    # rows in the file from the average length of the sampled lines
+    with open(path, "rb") as f:
+        f.readline()
+        lines = [len(f.readline()) for _ in range(sample_rows)]
+    lines = [n for n in lines if n] or [1]
+    line_bytes = sum(lines) / len(lines)
+    rows = int(os.path.getsize(path) / line_bytes)
+
+    # parsing a chunk holds its text of every column as well as the parsed kept columns
+    budget = max_memory_mb * 1e6 / max_workers
+    return {
+        "chunksize": max(int(budget / (2 * (line_bytes + row_bytes))), 1000),
+        "n_partitions": max(int(np.ceil(rows * row_bytes * expansion / budget)), 1),
+        "rows": rows,
+        "row_bytes": round(row_bytes, 1),
+    }
+
+
+def partition_table(path, columns, output_dir, n_partitions, chunksize=100_000, by="patdeid"):
+    """
+    Split a table into patient partitions on disk, reading it one chunk at a time. Every patient
+    lands in one partition, patdeid modulo n_partitions, and each partition is one parquet file
+    the chunks are appended to.
+
+    Parameters:
+    path (str): Path to the csv file.
+    columns (dict): Mapping of the columns to keep to their dtypes.
+    output_dir (str): Directory of the partition files.
+    n_partitions (int): Number of partitions.
+    chunksize (int): Rows read at a time.
+    by (str): The patient column.
+
+    Returns:
+    list: Paths of the non-empty partition files.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(output_dir, exist_ok=True)
+    writers = {}
+    try:
+        for chunk in read_table_chunks(path, columns, chunksize):
+            part = chunk[by].to_numpy() % n_partitions
+            for p, rows in chunk.groupby(part, sort=False):
+                table = pa.Table.from_pandas(rows, preserve_index=False)
+                if p not in writers:
+                    writers[p] = pq.ParquetWriter(os.path.join(output_dir, f"part-{p:05d}.parquet"), table.schema)
+                writers[p].write_table(table.cast(writers[p].schema))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return [os.path.join(output_dir, f"part-{p:05d}.parquet") for p in sorted(writers)]
+
+
+def _transform_partition(source, target, transform):
+    df = transform(pd.read_parquet(source))
+    df.to_parquet(target, index=False)
+    return target, len(df)
+
+
+@profiled
+def stream_table(path, columns, transform, output_dir, max_memory_mb=512, max_workers=1, n_partitions=None):
+    """
+    Run a per-patient transformation over a table larger than memory. The table is read in
+    chunks and split into patient partitions on disk, then each partition is transformed on
+    its own, in parallel processes when max_workers > 1, and written to a parquet file of the
+    output directory. Peak memory follows max_memory_mb through the chunk and partition sizes.
+
+    Parameters:
+    path (str): Path to the csv file, e.g. '../unlabeled_data/T_FRUDSAB.csv'.
+    columns (dict): Mapping of the columns to keep to their dtypes, e.g. TABLE_SCHEMAS['uds'][1].
+    transform (callable): Function of the long rows of a partition returning its features, e.g.
+    uds_transform. It must be importable by the worker processes.
+    output_dir (str): Directory of the output parquet files, read back with pd.read_parquet.
+    max_memory_mb (int): Memory cap of the whole run.
+    max_workers (int): Number of partitions transformed at once.
+    n_partitions (int, optional): Override the planned number of partitions.
+
+    Returns:
+    list: Paths of the output files.
+    """
+    import shutil
+    from concurrent.futures import ProcessPoolExecutor
+
+    plan = plan_partitions(path, columns, max_memory_mb, max_workers)
+    if n_partitions:
+        plan["n_partitions"] = n_partitions
+    print(f"Streaming about {plan['rows']} rows in chunks of {plan['chunksize']} into {plan['n_partitions']} partitions")
+
+    staging = os.path.join(output_dir, "_partitions")
+    parts = partition_table(path, columns, staging, plan["n_partitions"], plan["chunksize"])
+    targets = [os.path.join(output_dir, os.path.basename(part)) for part in parts]
+
+    try:
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(_transform_partition, parts, targets, [transform] * len(parts)))
+        else:
+            results = [_transform_partition(part, target, transform) for part, target in zip(parts, targets)]
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"Wrote {sum(n for _, n in results)} rows to {len(results)} files in {output_dir}")
+    return [target for target, _ in results]
+
+
+# coded event tables: file, week column (None for tables recorded at baseline) and code column
+EVENT_TABLES = {
+    "ae": ("AE.csv", "VISWKAE", "MEDRCODE"),
+    "sae": ("SAE.csv", "VISWKAE", "MEDRCODE"),
+    "conmed": ("CONMED.csv", None, "ATCCODE"),
+}
+
+
+def load_events(tables=EVENT_TABLES, data_path="../unlabeled_data/"):
+    """
+    Read the coded event tables, keeping the patient, the week and the code of every event.
+    Events without a patient or a code are dropped, tables without a week column are week 0.
+
+    Parameters:
+    tables (dict): Mapping of table names to (file name, week column, code column).
+    data_path (str): Directory of the csv files.
+
+    Returns:
+    dict: Mapping of table names to DataFrames with 'patdeid', 'week' and 'code'.
+    """
+    events = {}
+    for name, (file_name, week, code) in tables.items():
+        columns = ["patdeid", code] + ([week] if week else [])
+        df = pd.read_csv(os.path.join(data_path, file_name), usecols=columns, dtype={code: str})
+        df = df.rename(columns={code: "code", **({week: "week"} if week else {})})
+        if not week:
+            df["week"] = 0
+        df = df.dropna(subset=["patdeid", "code"])
+        events[name] = df.astype({"patdeid": "int32"})[["patdeid", "week", "code"]]
+        print(f"{name} events: {len(df)}, codes: {df['code'].nunique()}")
+
+    return events
+
+
+def event_vocabulary(codes, min_count=1, max_features=None):
+    """
+    Vocabulary of event codes, most frequent first.
+
+    Parameters:
+    codes (pandas.Series): The codes of the training events.
+    min_count (int): Codes seen fewer times are left out.
+    max_features (int, optional): Keep only the most frequent codes.
+
+    Returns:
+    pandas.Index: The codes, the position of a code is its feature column.
+    """
+    counts = codes.value_counts()
+    counts = counts[counts >= min_count]
+    return counts.index[:max_features]
+
+
+@profiled
+def encode_events(df, patients=None, vocabulary=None, n_features=None, max_week=None, by_week=False, prefix=""):
+    """
+    Count coded events per patient, or per patient and week, straight into a CSR sparse matrix,
+    without building the one-hot frame. Codes are mapped to columns through a vocabulary, or
+    hashed into n_features columns so unseen codes at scoring time still land in a column.
+
+    Parameters:
+    df (pandas.DataFrame): Events with 'patdeid', 'week' and 'code', see load_events.
+    patients (array-like, optional): Patients of the rows, e.g. the patdeid column of the wide
+    table so the rows line up with it. Defaults to the patients with events, sorted.
+    vocabulary (pandas.Index, optional): Codes of the columns, see event_vocabulary. Codes out
+    of the vocabulary are dropped. Defaults to the codes of the table, most frequent first.
+    n_features (int, optional): Hash the codes into this many columns instead.
+    max_week (int, optional): Only count events up to and including this week, e.g. the landmark.
+    by_week (bool): One row per patient and week (0 to the last week) instead of one per patient.
+    prefix (str): Prefix of the feature names, e.g. 'ae_'.
+
+    Returns:
+    dict: 'matrix' (scipy.sparse.csr_matrix of counts), 'patients', 'weeks' when by_week,
+    and the 'features' names of the columns.
+    """
+    from scipy import sparse
+
+    if max_week is not None:
+        df = df[df["week"] <= max_week]
+    df = df.dropna(subset=["week"]) if by_week else df
+
+    # rows: position of the patient, and of the week within the patient
+    patients = np.unique(df["patdeid"]) if patients is None else np.asarray(patients)
+    rows = pd.Index(patients).get_indexer(df["patdeid"])
+    n_rows = len(patients)
+    weeks = None
+    if by_week:
+        last = int(max_week if max_week is not None else df["week"].max() if len(df) else 0)
+        weeks = np.arange(0, last + 1)
+        week = df["week"].to_numpy().astype(int)
+        rows = np.where((rows >= 0) & (week >= 0), rows * len(weeks) + week, -1)
+        n_rows *= len(weeks)
+
+    # columns: hashed codes or positions in the vocabulary
+    codes = df["code"].astype(str).to_numpy()
+    if n_features is not None:
+        cols = (pd.util.hash_array(codes.astype(object)) % n_features).astype(np.int64)
+        features = [f"{prefix}hash{i}" for i in range(n_features)]
+    else:
+        vocabulary = event_vocabulary(df["code"].astype(str)) if vocabulary is None else vocabulary
+        cols = pd.Index(vocabulary).get_indexer(codes)
+        features = [f"{prefix}{code}" for code in vocabulary]
+
+    # events of other patients, weeks or codes are dropped, duplicates add up to counts
+    keep = (rows >= 0) & (cols >= 0)
+    matrix = sparse.csr_matrix(
+        (np.ones(keep.sum(), dtype=np.float32), (rows[keep], cols[keep])), shape=(n_rows, len(features))
+    )
+    matrix.sum_duplicates()
+
+    result = {"matrix": matrix, "patients": patients, "features": features}
+    if by_week:
+        result["weeks"] = weeks
+    return result
+
+
+def event_features(events, patients, max_week=None, vocabularies=None, min_count=1, n_features=None):
+    """
+    Sparse per-patient counts of every event table side by side, e.g. to add the adverse
+    events and concomitant medications to the wide feature table of the tree models:
+
+        events = helper.event_features(helper.load_events(), df["patdeid"], max_week=4)
+        X = scipy.sparse.hstack([scipy.sparse.csr_matrix(df[columns].to_numpy(float)), events["matrix"]]).tocsr()
+
+    Parameters:
+    events (dict): Table name to events, see load_events.
+    patients (array-like): Patients of the rows.
+    max_week (int, optional): Only count events up to and including this week.
+    vocabularies (dict, optional): Table name to vocabulary, fitted on these events up to max_week
+    when omitted; pass the returned vocabularies when encoding new patients.
+    min_count (int): Codes seen fewer times are left out of fitted vocabularies.
+    n_features (int, optional): Hash every table into this many columns instead of vocabularies.
+
+    Returns:
+    dict: 'matrix' (csr_matrix), 'features' names prefixed by the table name, and 'vocabularies'.
+    """
+    from scipy import sparse
+
+    vocabularies = dict(vocabularies or {})
+    blocks, features = [], []
+    for name, df in events.items():
+        # the vocabulary only holds codes seen up to the landmark, later codes would be empty columns
+        if max_week is not None:
+            df = df[df["week"] <= max_week]
+        if n_features is None and name not in vocabularies:
+            vocabularies[name] = event_vocabulary(df["code"].astype(str), min_count)
+        encoded = encode_events(
+            df, patients, vocabularies.get(name), n_features, max_week=max_week, prefix=f"{name}_"
+        )
+        blocks.append(encoded["matrix"])
+        features.extend(encoded["features"])
+
+    return {"matrix": sparse.hstack(blocks, format="csr"), "features": features, "vocabularies": vocabularies}
+
+
+# week suffix of a wide column name, e.g. 'test_opiate300_3' -> '3', as parsed by column_index
+_WEEK_SUFFIX = re.compile(r"_(\d+)$")
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_columns(columns):
+    """
+    Parse a tuple of column names into (source, measure, week), see column_index.
+    """
+    parts = pd.Series(columns, dtype=object).str.extract(r"^(?:([a-z]+)_)?(.*?)(?:_(\d+))?$")
+    parts.columns = ["source", "measure", "week"]
+    parts.index = pd.Index(columns)
+    parts["source"] = parts["source"].fillna("")
+    parts["week"] = parts["week"].astype(float)
+    return parts
+
+
+def column_index(df):
+    """
+    Map every column of a wide feature frame to the table it comes from, the measure and the week,
+    e.g. 'test_opiate300_3' -> ('test', 'opiate300', 3.0) and 'pex_skin' -> ('pex', 'skin', NaN).
+    The index is parsed once per set of columns, later calls get a copy of it.
+
+    Parameters:
+    df (pandas.DataFrame): The wide dataframe.
+
+    Returns:
+    pandas.DataFrame: One row per column with 'source', 'measure' and 'week'.
+    """
+    return _parse_columns(tuple(df.columns)).copy()
+
+
+def select_columns(df, source=None, measures=None, week=None, max_week=None):
+    """
+    Select column names through the column index, e.g. all opiate tests for weeks <= 4 with
+    select_columns(df, "test", ["opiate300"], max_week=4) or all surveys at week 8 with
+    select_columns(df, "survey", week=8). Columns keep their order in the dataframe.
+
+    Parameters:
+    df (pandas.DataFrame): The wide dataframe.
+    source (str, optional): The source table prefix, e.g. 'test', 'survey', 'meds'.
+    measures (list, optional): Measures to keep, a measure matches when it starts with a list item.
+    week (int, optional): Keep only this week.
+    max_week (int, optional): Keep weeks up to and including this week.
+
+    Returns:
+    list: The selected column names.
+    """
+    index = column_index(df)
+    mask = np.ones(len(index), dtype=bool)
+
+    if source is not None:
+        mask &= (index["source"] == source.rstrip("_")).to_numpy()
+    if measures is not None:
+        mask &= index["measure"].str.startswith(tuple(measures)).to_numpy()
+    if week is not None:
+        mask &= (index["week"] == week).to_numpy()
+    if max_week is not None:
+        mask &= (index["week"] <= max_week).to_numpy()
+
+    return index.index[mask].tolist()
+
+
+# compact dtypes of the feature table, looked up by column name, then measure, then source table
+# nullable integers keep missing values without upcasting to float64
+FEATURE_DTYPES = {
+    # outcome metrics and single columns
+    "patdeid": "int32",
+    "VISIT": "int16",
+    "TNT": "Int16",
+    "CNT": "Int16",
+    "NTR": "Float32",
+    "responder": "Int8",
+    "dropout": "Int8",
+    "medication": "Int8",
+    "gender": "Int8",
+    "weeks_attended": "Int16",
+    # weekly binary tests and attendance
+    "test": "Int8",
+    "rsa": "Int8",
+    # counts and scores
+    "survey": "Int16",
+    "cows": "Int8",
+    "rbs": "Int16",
+    # doses
+    "meds": "Float32",
+    # coded answers
+    "dsm": "category",
+    "mdh": "category",
+    "pex": "category",
+}
+
+
+def feature_dtypes(df):
+    """
+    Build the typed schema of a feature table, long (test_opiate300) or wide (test_opiate300_4),
+    from FEATURE_DTYPES. Columns without an entry keep float32 for floats and category for text.
+
+    Parameters:
+    df (pandas.DataFrame): The feature table.
+
+    Returns:
+    dict: Mapping of every column to its compact dtype.
+    """
+    index = column_index(df)
+
+    schema = {}
+    for col, source, measure in zip(index.index, index["source"], index["measure"]):
+        dtype = FEATURE_DTYPES.get(col) or FEATURE_DTYPES.get(measure if not source else None) or FEATURE_DTYPES.get(source)
+        if dtype is None:
+            kind = df[col].dtype.kind
+            dtype = "float32" if kind == "f" else "category" if kind == "O" else df[col].dtype
+        schema[col] = dtype
+
+    return schema
+
+
+@profiled
+def compact_dtypes(df, schema=None):
+    """
+    Downcast a feature table to its typed schema: binary tests and attendance to Int8, counts
+    to small integers, doses to Float32 and coded answers to categoricals. A column whose values
+    do not fit its integer dtype, e.g. imputed fractions, falls back to Float32.
+
+    Parameters:
+    df (pandas.DataFrame): The feature table.
+    schema (dict, optional): Mapping of columns to dtypes, defaults to feature_dtypes(df).
+
+    Returns:
+    pandas.DataFrame: The table with compact dtypes.
+    """
+    schema = schema or feature_dtypes(df)
+
+    columns = {}
+    for col in df.columns:
+        dtype = schema.get(col, df[col].dtype)
+        try:
+            columns[col] = df[col].astype(dtype)
+        except (TypeError, ValueError):
+            columns[col] = pd.to_numeric(df[col], errors="coerce").astype("Float32")
+
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _profile_chunk(df):
+    """
+    Count the values of every column in one melt/groupby pass per dtype, and collect the
+    running statistics (rows, nulls, sum, sum of squares, min, max) of every numeric column.
+    """
+    # one long (column, value) table per dtype, so that equal values of different dtypes
+    # (3 and 3.0) are not merged into one index label; nulls are dropped as in value_counts
+    counts = {}
+    for dtype, columns in df.columns.groupby(df.dtypes).items():
+        long = df[columns].melt(var_name="column", value_name="value").dropna(subset=["value"])
+        counts[dtype] = long.groupby(["column", "value"], sort=False).size()
+
+    # min and max keep the dtype of their column, sums are accumulated as floats
+    numeric = df.select_dtypes("number")
+    floats = numeric.astype(float)
+    stats = pd.DataFrame(
+        {
+            "rows": len(df),
+            "nulls": df.isna().sum(),
+            "sum": floats.sum(),
+            "sumsq": (floats**2).sum(),
+            "min": pd.Series({col: numeric[col].min() for col in numeric.columns}, dtype=object),
+            "max": pd.Series({col: numeric[col].max() for col in numeric.columns}, dtype=object),
+        },
+        index=df.columns,
+    )
+
+    return counts, stats
+
+
+def _combine_extremes(current, chunk, keep):
+    """
+    Element-wise min or max of two object Series of column extremes, ignoring missing ones.
+    """
+    return current.combine(chunk, lambda a, b: b if pd.isna(a) else a if pd.isna(b) else keep(a, b))
+
+
+def _is_numpy_number(dtype):
+    return isinstance(dtype, np.dtype) and dtype.kind in "iuf"
+
+
+def _common_dtype(a, b):
+    """
+    Dtype of a column read as a in some chunks and as b in others, e.g. float64 for an integer
+    column with nulls in some chunks only.
+    """
+    if a == b:
+        return a
+    if _is_numpy_number(a) and _is_numpy_number(b):
+        return np.result_type(a, b)
+    return np.dtype(object)
+
+
+def _cast_counts(counts, dtypes):
+    """
+    Move the counts of columns read with different dtypes in different chunks (an integer
+    column with nulls in some chunks only) to their common dtype, as a whole-file read.
+    """
+    moved = {}
+    for dtype, group in counts.items():
+        group_columns = group.index.get_level_values("column")
+        for final, columns in pd.Index(group_columns.unique()).groupby(dtypes[group_columns.unique()]).items():
+            part = group[group_columns.isin(columns)]
+            if final != dtype:
+                values = part.index.get_level_values("value").astype(final)
+                part.index = pd.MultiIndex.from_arrays([part.index.get_level_values("column"), values])
+            moved.setdefault(final, []).append(part)
+
+    return {
+        dtype: parts[0] if len(parts) == 1 else pd.concat(parts).groupby(level=[0, 1], sort=False).sum()
+        for dtype, parts in moved.items()
+    }
+
+
+def _finish_profile(columns, counts, stats):
+    """
+    Turn the accumulated counts and statistics into the value counts and summary tables.
+    """
+    # values are kept as objects so that each column keeps its own value types
+    counts = pd.concat(
+        [group.rename("count").reset_index().astype({"value": object}) for group in counts.values()],
+        ignore_index=True,
+    )
+
+    # order by column, then by count as in value_counts
+    counts["order"] = counts["column"].map({col: i for i, col in enumerate(columns)})
+    counts = counts.sort_values(["order", "count"], ascending=[True, False], kind="stable")
+    totals = counts.groupby("column")["count"].transform("sum")
+    counts["percentage"] = (counts["count"] / totals).round(2)
+    value_counts = counts[["column", "value", "count", "percentage"]].reset_index(drop=True)
+
+    non_null = stats["rows"] - stats["nulls"]
+    mean = stats["sum"] / non_null
+    summary = pd.DataFrame(
+        {
+            "count": non_null,
+            "null_rate": (stats["nulls"] / stats["rows"]).round(4),
+            "unique": value_counts.groupby("column").size().reindex(columns, fill_value=0),
+            "mean": mean,
+            "std": np.sqrt((stats["sumsq"] / non_null - mean**2).clip(lower=0) * non_null / (non_null - 1)),
+            "min": stats["min"],
+            "max": stats["max"],
+        }
+    ).reindex(columns)
+    summary.index.name = "column"
+
+    return value_counts, summary
+
+
+@profiled
+def profile_df(df):
+    """
+    Profile every column of a DataFrame in one vectorized pass: value counts with percentages,
+    and a summary of null rate, number of unique values and distribution of numeric columns.
+    Values, min and max keep the dtype of their column.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to profile.
+
+    Returns:
+    tuple: (value counts DataFrame with 'column', 'value', 'count', 'percentage',
+    summary DataFrame indexed by column with 'count', 'null_rate', 'unique', 'mean', 'std', 'min', 'max')
+    """
+    counts, stats = _profile_chunk(df)
+    return _finish_profile(list(df.columns), counts, stats)
+
+
+@profiled
+def profile_csv(path, chunksize=100_000, **kwargs):
+    """
+    Profile a csv file that may not fit in memory, reading it in chunks and combining the counts
+    and running statistics of every chunk. Gives the same result as profile_df on the whole file:
+    a column read as integers in some chunks and as floats in others (nulls in those chunks only)
+    is reported as floats, integer columns without nulls keep their integer values.
+
+    Parameters:
+    path (str): Path to the csv file.
+    chunksize (int): Rows read per chunk.
+    **kwargs: Extra arguments for pd.read_csv, e.g. usecols or dtype.
+
+    Returns:
+    tuple: The value counts and summary DataFrames, as profile_df.
+    """
+    counts, stats, dtypes = None, None, None
+    for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+        chunk_counts, chunk_stats = _profile_chunk(chunk)
+        if counts is None:
+            counts, stats, dtypes = chunk_counts, chunk_stats, chunk.dtypes
+            continue
+
+        for dtype, group in chunk_counts.items():
+            counts[dtype] = group if dtype not in counts else counts[dtype].add(group, fill_value=0).astype(int)
+        dtypes = pd.Series({col: _common_dtype(dtypes[col], chunk.dtypes[col]) for col in dtypes.index}, dtype=object)
+        stats = pd.DataFrame(
+            {
+                "rows": stats["rows"] + chunk_stats["rows"],
+                "nulls": stats["nulls"] + chunk_stats["nulls"],
+                "sum": stats["sum"].add(chunk_stats["sum"], fill_value=0),
+                "sumsq": stats["sumsq"].add(chunk_stats["sumsq"], fill_value=0),
+                "min": _combine_extremes(stats["min"], chunk_stats["min"], min),
+                "max": _combine_extremes(stats["max"], chunk_stats["max"], max),
+            }
+        )
+
+    if counts is None:
+        raise ValueError(f"No rows to profile in {path}")
+
+    # extremes and counts of columns whose dtype changed between chunks take the common dtype
+    counts = _cast_counts(counts, dtypes)
+    for col in ("min", "max"):
+        stats[col] = pd.Series(
+            {
+                name: dtypes[name].type(value) if _is_numpy_number(dtypes[name]) and not pd.isna(value) else value
+                for name, value in stats[col].items()
+            },
+            dtype=object,
+        )
+
+    return _finish_profile(list(dtypes.index), counts, stats)
+
+
+@profiled
+def df_value_counts(df):
+    """
+    This function takes a DataFrame and returns a DataFrame with the value counts of each column.
+
+    Parameters:
+    df: pandas DataFrame
+
+
+    Returns:
+    pandas DataFrame
+
+    """
+    value_counts, _ = profile_df(df)
+    return value_counts
+
+
+def search_suffix(col_name, max_week=4):
+    """
+    Function to check if the suffix of the column name is numerically <= max_week
+    The suffix represents the week of treatment
+    we only want columns that include data from the first 4 weeks of treat
+
+    Parameters:
+    col_name (str): The column name to check
+    max_week (int): The last week of treatment to include
+
+    Returns:
+    bool: True if the suffix is <= max_week, False
+
+    """
+    match = _WEEK_SUFFIX.search(col_name)
+    return bool(match) and int(match.group(1)) <= max_week
+
+
+def _display(obj):
+    # rich output inside notebooks, printed by scripts and workers
+    try:
+        from IPython.display import display
+    except ImportError:
+        print(obj)
+    else:
+        display(obj)
+
+
+@profiled
+def feature_selection(df, prefix, feature_list, max_week=4):
+    """
+    Selects features from tests and survey data to form granualar level data quality
+    when building data models for machine learning
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame containing the tests and survey data.
+    prefix (str): The data category, e.g. 'test_' or 'survey_'.
+    feature_list (list): A list of drug names to select from the DataFrame.
+    max_week (int): The last week of treatment to include.
+
+    Returns:
+    pandas.DataFrame: The selected features from the DataFrame.
+
+    """
+
+    matching_columns = select_columns(df, prefix, feature_list, max_week=max_week)
+
+    # Use the matching_columns list to select the columns from the DataFrame
+    tests = df[matching_columns]
+
+    print("Shape of tests DataFrame:", tests.shape)
+    _display(tests)
+
+    return tests
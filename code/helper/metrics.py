@@ -0,0 +1,218 @@
+"""
+Concordance index and other evaluation metrics.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .profiling import profiled
+
+
+def cindex(y_true, scores):
+    """
+    Calculate the concordance index for the given true values and predicted scores.
+    Parameters:
+    y_true (array-like): The true values.
+    scores (array-like): The predicted scores.
+    Returns:
+    float: The concordance index.
+    """
+    import lifelines
+    return lifelines.utils.concordance_index(y_true, scores)
+
+
+def batch_cindex(y_true, scores):
+    """
+    Calculate the concordance index for many score vectors at once, e.g. every classifier and
+    every bootstrap resample. Gives the same value as cindex for each vector: pairs with
+    different true values count as 1 when the scores are in the same order, 0.5 when the scores
+    are tied, and pairs with equal true values are ignored.
+
+    The pairs are counted with ranks instead of pair by pair: for each level of the true values,
+    the rank of a score among all rows up to that level, minus its rank within the level, is
+    the number of lower rows it beats. The cost is one ranking per level of y_true, so this is
+    meant for discrete labels such as dropout.
+
+    Parameters:
+    y_true (array-like): The true values, shape (n,) or one row per score vector (k, n).
+    scores (array-like): The predicted scores, shape (n,) or (k, n).
+
+    Returns:
+    numpy.ndarray: The concordance index of each score vector, NaN when no pair is comparable.
+    """
+    from scipy.stats import rankdata
+
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    y_true = np.broadcast_to(np.asarray(y_true, dtype=float), scores.shape)
+
+    concordant = np.zeros(scores.shape[0])
+    pairs = np.zeros(scores.shape[0])
+    below = np.zeros(scores.shape, dtype=bool)
+    for level in np.unique(y_true):
+        current = y_true == level
+        upto = below | current
+
+        # the lowest level has no lower rows to beat
+        if not below.any():
+            below = upto
+            continue
+
+        # ranks among the rows up to this level, and among the rows at this level
+        rank_upto = rankdata(np.where(upto, scores, np.inf), axis=-1)
+        rank_level = rankdata(np.where(current, scores, np.inf), axis=-1)
+
+        concordant += np.where(current, rank_upto - rank_level, 0).sum(axis=-1)
+        pairs += current.sum(axis=-1) * below.sum(axis=-1)
+        below = upto
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return concordant / pairs
+
+
+@profiled
+def bootstrap_cindex(y_true, scores, names=None, n_boot=1000, alpha=0.05, random_state=0, chunk_size=None):
+    """
+    Calculate the concordance index with a percentile bootstrap confidence interval for one
+    or more score vectors. Every score vector is evaluated on the same resamples, so the
+    intervals of different models are comparable.
+
+    Parameters:
+    y_true (array-like): The true values, shape (n,).
+    scores (array-like): The predicted scores, shape (n,) or one row per model (k, n).
+    names (list, optional): Name of each score vector, e.g. the classifier names.
+    n_boot (int): Number of bootstrap resamples.
+    alpha (float): Confidence level of the interval is 1 - alpha.
+    random_state (int): Seed for the resamples.
+    chunk_size (int, optional): Resamples evaluated per batch, bounds the memory used.
+
+    Returns:
+    pandas.DataFrame: One row per score vector with 'cindex', 'ci_lower', 'ci_upper' and 'std'.
+    """
+    y_true = np.asarray(y_true, dtype=float)
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    k, n = scores.shape
+
+    # about 5 million values per batch unless given
+    chunk_size = chunk_size or max(1, 5_000_000 // (k * n))
+
+    rng = np.random.RandomState(random_state)
+    boot = np.empty((k, n_boot))
+    for start in range(0, n_boot, chunk_size):
+        stop = min(start + chunk_size, n_boot)
+        idx = rng.randint(0, n, size=(stop - start, n))
+
+        # (models x resamples x rows), with the labels shared by every model
+        batch = batch_cindex(
+            np.broadcast_to(y_true[idx], (k,) + idx.shape).reshape(-1, n),
+            scores[:, idx].reshape(-1, n),
+        )
+        boot[:, start:stop] = batch.reshape(k, -1)
+
+    return pd.DataFrame(
+        {
+            "cindex": batch_cindex(y_true, scores),
+            "ci_lower": np.nanpercentile(boot, 100 * alpha / 2, axis=1),
+            "ci_upper": np.nanpercentile(boot, 100 * (1 - alpha / 2), axis=1),
+            "std": np.nanstd(boot, axis=1),
+        },
+        index=names,
+    )
+
+
+def cindex_scorer(estimator, X, y):
+    """
+    Scorer for scikit-learn model selection, the C-index of the predicted probability of
+    the positive class.
+
+    Parameters:
+    estimator: A fitted classifier with predict_proba.
+    X (array-like): The features.
+    y (array-like): The true labels.
+
+    Returns:
+    float: The concordance index.
+    """
+    return cindex(np.asarray(y), estimator.predict_proba(X)[:, 1])
+
+
+@profiled
+def threshold_sweep(y_true, scores, names=None, thresholds=None, n_bins=10):
+    """
+    Confusion counts, precision, recall and specificity of one or more classifiers at every
+    threshold, and their calibration bins, from already computed predict_proba outputs.
+    The scores of each classifier are sorted once, then the counts at any threshold are read
+    off the cumulative positives with a binary search instead of recomputing the metrics per
+    threshold. A row is predicted positive when its score is >= the threshold.
+
+    Parameters:
+    y_true (array-like): The true binary labels, shape (n,).
+    scores (array-like): The predicted probabilities, shape (n,) or one row per classifier (k, n).
+    names (list, optional): Name of each classifier, numbered from 0 by default.
+    thresholds (int or array-like, optional): The thresholds, a number of evenly spaced ones
+    in [0, 1], or by default every distinct score of each classifier.
+    n_bins (int): Number of equal width calibration bins in [0, 1].
+
+    Returns:
+    dict: 'sweep', a DataFrame with one row per classifier and threshold with 'tp', 'fp', 'tn',
+    'fn', 'precision', 'recall' and 'specificity', and 'calibration', a DataFrame with one
+    row per classifier and non-empty bin with 'mean_predicted', 'fraction_positive' and 'count'.
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    names = list(range(len(scores))) if names is None else list(names)
+    if isinstance(thresholds, (int, np.integer)):
+        thresholds = np.linspace(0, 1, thresholds)
+
+    n = len(y_true)
+    edges = np.linspace(0, 1, n_bins + 1)[1:-1]
+    sweeps, calibration = [], []
+    for name, score in zip(names, scores):
+        # one sort, then cumulative positives and scores over the ascending scores
+        order = np.argsort(score, kind="stable")
+        ordered = score[order]
+        below_pos = np.concatenate([[0], np.cumsum(y_true[order])])
+        below_sum = np.concatenate([[0.0], np.cumsum(ordered)])
+        positives = below_pos[-1]
+
+        # rows below the threshold are predicted negative
+        cuts = np.unique(ordered) if thresholds is None else np.asarray(thresholds, dtype=float)
+        below = np.searchsorted(ordered, cuts, side="left")
+        fn = below_pos[below]
+        tp = positives - fn
+        fp = n - below - tp
+        tn = below - fn
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sweeps.append(
+                pd.DataFrame(
+                    {
+                        "classifier": name,
+                        "threshold": cuts,
+                        "tp": tp,
+                        "fp": fp,
+                        "tn": tn,
+                        "fn": fn,
+                        "precision": tp / (tp + fp),
+                        "recall": tp / positives,
+                        "specificity": tn / (n - positives),
+                    }
+                )
+            )
+
+        # bins are (lower, upper], the first one includes 0
+        bounds = np.concatenate([[0], np.searchsorted(ordered, edges, side="right"), [n]])
+        count = np.diff(bounds)
+        keep = count > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            calibration.append(
+                pd.DataFrame(
+                    {
+                        "classifier": name,
+                        "bin": np.arange(n_bins)[keep],
+                        "mean_predicted": (np.diff(below_sum[bounds]) / count)[keep],
+                        "fraction_positive": (np.diff(below_pos[bounds]) / count)[keep],
+                        "count": count[keep],
+                    }
+                )
+            )
+
+    return {"sweep": pd.concat(sweeps, ignore_index=True), "calibration": pd.concat(calibration, ignore_index=True)}
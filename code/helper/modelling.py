@@ -0,0 +1,625 @@
+"""
+Imputation, hyperparameter search, model bundles, scoring and SHAP explanations.
+"""
+
+import hashlib
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from .cache import CACHE_DIR, _update_digest, cached_stage
+from .etl import column_index, select_columns
+from .metrics import cindex, cindex_scorer
+from .profiling import profiled
+
+
+# column groups imputed together, given as a column list or a column prefix
+# binary columns such as gender are not imputed here, the mean would give fractional values
+IMPUTATION_GROUPS = {
+    "cows": ["cows_predose", "cows_postdose"],
+    "rbs": "rbs_",
+}
+
+
+def _group_columns(df, columns):
+    # a prefix selects every column starting with it, a list is taken as is
+    if isinstance(columns, str):
+        return [col for col in df.columns if col.startswith(columns)]
+    return list(columns)
+
+
+def _fit_imputer(name, X, max_iter, tol, random_state):
+    from sklearn.experimental import enable_iterative_imputer  # noqa: F401
+    from sklearn.impute import IterativeImputer
+
+    tic = time.perf_counter()
+    # columns without any value are kept (imputed as 0), so transform returns every group column
+    imputer = IterativeImputer(max_iter=max_iter, tol=tol, random_state=random_state, keep_empty_features=True)
+    imputer.fit(X)
+
+    return name, imputer, time.perf_counter() - tic
+
+
+@profiled
+def fit_imputers(df, groups=IMPUTATION_GROUPS, max_iter=10, tol=1e-3, random_state=0, n_jobs=-1):
+    """
+    Fit one IterativeImputer per column group, all groups concurrently, so the fitted imputers
+    can be saved with the model and applied to new patients without refitting.
+
+    Parameters:
+    df (pandas.DataFrame): The merged table.
+    groups (dict): Group name to a list of columns or a column prefix, e.g. {'rbs': 'rbs_'}.
+    Groups of a single column are imputed with its mean, columns without any value with 0.
+    max_iter (int): Maximum imputation rounds per group.
+    tol (float): Tolerance of the stopping criterion.
+    random_state (int): Seed of the imputers.
+    n_jobs (int): Number of parallel jobs, -1 uses all cores.
+
+    Returns:
+    dict: Group name to {'columns', 'imputer', 'missing', 'empty', 'n_iter', 'converged', 'seconds'},
+    'empty' listing the columns that had no value at fit time.
+    """
+    from joblib import Parallel, delayed
+
+    columns = {name: _group_columns(df, cols) for name, cols in groups.items()}
+    columns = {name: cols for name, cols in columns.items() if cols}
+
+    fitted = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_imputer)(name, df[cols].to_numpy(dtype=float), max_iter, tol, random_state)
+        for name, cols in columns.items()
+    )
+
+    imputers = {}
+    for name, imputer, seconds in fitted:
+        n_iter = getattr(imputer, "n_iter_", 0)
+        imputers[name] = {
+            "columns": columns[name],
+            "imputer": imputer,
+            "missing": int(df[columns[name]].isna().sum().sum()),
+            "empty": [col for col in columns[name] if df[col].isna().all()],
+            "n_iter": n_iter,
+            "converged": n_iter < max_iter,
+            "seconds": round(seconds, 3),
+        }
+
+    return imputers
+
+
+def imputation_report(imputers):
+    """
+    Convergence and timing of fitted imputers.
+
+    Returns:
+    pandas.DataFrame: One row per group with the columns, nulls at fit time, columns without
+    any value (imputed as 0), rounds run, whether the tolerance was reached and the fit time.
+    """
+    return pd.DataFrame(
+        [
+            {
+                "group": name,
+                "columns": len(group["columns"]),
+                "missing": group["missing"],
+                "empty": len(group.get("empty", [])),
+                "n_iter": group["n_iter"],
+                "converged": group["converged"],
+                "seconds": group["seconds"],
+            }
+            for name, group in imputers.items()
+        ]
+    ).set_index("group")
+
+
+@profiled
+def apply_imputers(df, imputers):
+    """
+    Impute the column groups of a table with imputers fitted by fit_imputers, without refitting.
+    Group columns missing from the table are added as nulls and imputed.
+
+    Parameters:
+    df (pandas.DataFrame): Table to impute, e.g. new patient rows.
+    imputers (dict): The fitted imputers.
+
+    Returns:
+    pandas.DataFrame: A copy of the table with the groups imputed.
+    """
+    df = df.copy()
+    for group in imputers.values():
+        cols = group["columns"]
+        X = df.reindex(columns=cols).to_numpy(dtype=float)
+        if np.isnan(X).any():
+            df[cols] = group["imputer"].transform(X)
+        else:
+            df[cols] = X
+
+    return df
+
+
+def save_imputers(path, imputers):
+    """
+    Persist fitted imputers, e.g. '../models/imputers.joblib'.
+    """
+    import joblib
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    joblib.dump(imputers, path)
+    return path
+
+
+def load_imputers(path):
+    """
+    Load imputers written by save_imputers.
+    """
+    import joblib
+
+    return joblib.load(path)
+
+
+def save_model_bundle(path, preprocessor, classifier, columns, imputers=None):
+    """
+    Persist everything needed to score new patients in one file: the fitted preprocessor,
+    the fitted classifier and the column schema the preprocessor expects.
+
+    Parameters:
+    path (str): Path of the bundle file, e.g. '../models/dropout.joblib'.
+    preprocessor: The fitted ColumnTransformer.
+    classifier: The fitted classifier with predict_proba.
+    columns (list): The feature columns, in training order.
+    imputers (dict, optional): Imputers from fit_imputers, applied before the preprocessor.
+
+    Returns:
+    str: The path of the bundle.
+    """
+    import joblib
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    bundle = {"preprocessor": preprocessor, "classifier": classifier, "columns": list(columns), "imputers": imputers}
+    joblib.dump(bundle, path)
+    return path
+
+
+def load_model_bundle(path):
+    """
+    Load a model bundle written by save_model_bundle.
+
+    Parameters:
+    path (str): Path of the bundle file.
+
+    Returns:
+    dict: The bundle with 'preprocessor', 'classifier', 'columns' and 'imputers'.
+    """
+    import joblib
+
+    return joblib.load(path)
+
+
+@profiled
+def score_rows(bundle, rows):
+    """
+    Score patient rows with a model bundle. Rows are aligned to the bundle's column schema,
+    extra fields are ignored and missing features are null, then imputed when the bundle
+    holds imputers.
+
+    Parameters:
+    bundle (dict): The bundle from load_model_bundle.
+    rows (pandas.DataFrame or list): Patient rows, a dataframe or a list of dicts.
+
+    Returns:
+    numpy.ndarray: The dropout probability of each row.
+    """
+    df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame.from_records(rows)
+    df = df.reindex(columns=bundle["columns"])
+    if bundle.get("imputers"):
+        df = apply_imputers(df, bundle["imputers"])[bundle["columns"]]
+
+    X = bundle["preprocessor"].transform(df) if bundle["preprocessor"] is not None else df
+    return bundle["classifier"].predict_proba(X)[:, 1]
+
+
+def _take_rows(X, rows):
+    """
+    Select rows by position from a DataFrame, array or sparse matrix.
+    """
+    return X.iloc[rows] if hasattr(X, "iloc") else X[rows]
+
+
+def _fit_fold(estimator, params, X, y, train, test):
+    """
+    Fit one configuration on one fold and score it on the held out rows.
+    """
+    from sklearn.base import clone
+
+    model = clone(estimator).set_params(**params)
+    model.fit(_take_rows(X, train), y[train])
+    return cindex_scorer(model, _take_rows(X, test), y[test])
+
+
+@profiled
+def search_hyperparams(
+    classifier,
+    hyperparams,
+    X,
+    y,
+    cv=5,
+    factor=3,
+    min_resources=None,
+    n_jobs=-1,
+    random_state=0,
+    cache_dir=CACHE_DIR,
+):
+    """
+    Successive halving search over a parameter grid, scored with the C-index.
+
+    Every configuration is first cross validated on a small sample of the training rows, the
+    best 1/factor of them move on to a sample factor times larger, and so on until the last
+    round uses every row. Folds are fitted in parallel across processes, and the fold scores
+    are stored in the cache keyed on the data, the configuration and the sample, so reruns and
+    extended grids only fit the configurations that were not seen before.
+
+    Parameters:
+    classifier: The classifier to use (e.g., XGBClassifier()).
+    hyperparams (dict): Dictionary of hyperparameters to search, as for GridSearchCV.
+    X (array-like): Training features, DataFrame, array or sparse matrix.
+    y (array-like): Training labels.
+    cv (int): Number of stratified folds.
+    factor (int): Fraction of configurations kept, and growth of the sample, per round.
+    min_resources (int, optional): Rows used in the first round, defaults to 20 rows per fold.
+    n_jobs (int): Number of processes, -1 uses every core.
+    random_state (int): Seed for the row sample and the folds.
+    cache_dir (str): Directory of the fold score cache.
+
+    Returns:
+    pandas.DataFrame: One row per configuration and round with the fold scores,
+    'mean_test_score' and 'rank_test_score', rank 1 is the best configuration of the last round.
+    """
+    import json
+    from joblib import Parallel, delayed
+    from sklearn.base import clone
+    from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+    y = np.asarray(y)
+    n_samples = len(y)
+    candidates = list(ParameterGrid(hyperparams))
+
+    # number of rounds, so the last round uses every row and the first at least min_resources
+    min_resources = min_resources or 20 * cv
+    n_rounds = 1 + int(np.floor(np.log(max(len(candidates), 1)) / np.log(factor)))
+    n_rounds = max(1, min(n_rounds, 1 + int(np.floor(np.log(n_samples / min_resources) / np.log(factor)))))
+
+    # fixed row order, the sample of each round is a prefix of it
+    order = np.random.RandomState(random_state).permutation(n_samples)
+
+    # fold scores already computed for this data
+    digest = hashlib.sha256()
+    _update_digest(digest, [X, y, cv, random_state])
+    cache_path = os.path.join(cache_dir, f"search-{digest.hexdigest()[:20]}.json")
+    scores = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            scores = json.load(f)
+
+    def config_key(params, n_resources):
+        model = clone(classifier).set_params(**params)
+        settings = sorted((k, repr(v)) for k, v in model.get_params(deep=False).items())
+        return hashlib.sha256(repr((type(model).__qualname__, settings, n_resources)).encode()).hexdigest()
+
+    rows = []
+    for round_ in range(n_rounds):
+        n_resources = n_samples if round_ == n_rounds - 1 else min_resources * factor**round_
+        sample = np.sort(order[:n_resources])
+        folds = list(
+            StratifiedKFold(n_splits=cv, shuffle=True, random_state=random_state).split(
+                np.zeros(n_resources), y[sample]
+            )
+        )
+
+        # fit only the configurations missing from the cache
+        keys = [config_key(params, n_resources) for params in candidates]
+        todo = [(key, params) for key, params in zip(keys, candidates) if key not in scores]
+        fitted = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_fold)(classifier, params, X, y, sample[train], sample[test])
+            for _, params in todo
+            for train, test in folds
+        )
+        for i, (key, _) in enumerate(todo):
+            scores[key] = fitted[i * cv : (i + 1) * cv]
+
+        print(
+            f"Round {round_ + 1}/{n_rounds}: {len(candidates)} candidates on {n_resources} rows,",
+            f"{len(todo)} fitted, {len(candidates) - len(todo)} from cache",
+        )
+
+        for key, params in zip(keys, candidates):
+            row = {"iter": round_, "n_resources": n_resources, "params": params}
+            row.update({f"split{k}_test_score": score for k, score in enumerate(scores[key])})
+            row["mean_test_score"] = np.mean(scores[key])
+            row["std_test_score"] = np.std(scores[key])
+            rows.append(row)
+
+        # keep the best 1/factor of the configurations for the next round
+        means = np.array([np.mean(scores[key]) for key in keys])
+        keep = max(1, int(np.ceil(len(candidates) / factor)))
+        candidates = [candidates[i] for i in np.argsort(-means, kind="stable")[:keep]]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, "w") as f:
+        json.dump(scores, f)
+
+    # rank the last round first, then by score
+    results = pd.DataFrame(rows)
+    ranked = results.sort_values(["iter", "mean_test_score"], ascending=[False, False], kind="stable")
+    results.loc[ranked.index, "rank_test_score"] = np.arange(1, len(results) + 1)
+    results["rank_test_score"] = results["rank_test_score"].astype(int)
+
+    return results
+
+
+# landmark weeks the dropout risk is predicted at
+LANDMARKS = (1, 2, 4, 8, 12)
+
+
+def landmark_matrix(df, landmarks=LANDMARKS, sources=("test", "survey", "meds"), static=()):
+    """
+    Lay out the wide feature table once for every landmark: the static columns first, then the
+    weekly columns of the sources ordered by week. The features known at landmark week k are
+    then the first n_k columns, so each landmark's slice extends the previous one and is a view
+    of the same array, X[:, :n_k], without copying.
+
+    Parameters:
+    df (pandas.DataFrame): The preprocessed wide table, numeric features.
+    landmarks (list): The landmark weeks.
+    sources (list): Source tables of the weekly columns, e.g. 'test', 'survey', 'meds'.
+    static (list): Columns known at baseline, included at every landmark, e.g. ['cows_predose'].
+
+    Returns:
+    tuple: (X, columns, bounds), the float array in column-major order, its column names, and
+    the number of leading columns of each landmark.
+    """
+    landmarks = sorted(landmarks)
+    index = column_index(df)
+
+    # weekly columns up to the last landmark, ordered by week and then by position in the table
+    weekly = [col for source in sources for col in select_columns(df, source, max_week=landmarks[-1])]
+    weekly = sorted(weekly, key=lambda col: (index.at[col, "week"], df.columns.get_loc(col)))
+    columns = list(static) + weekly
+
+    weeks = np.r_[np.full(len(static), -np.inf), index.loc[weekly, "week"].to_numpy(dtype=float)]
+    bounds = {week: int(np.searchsorted(weeks, week, side="right")) for week in landmarks}
+
+    X = np.asfortranarray(df[columns].to_numpy(dtype=float))
+    return X, columns, bounds
+
+
+def _fit_landmark(estimator, X_train, y_train, X_test, y_test, n_columns):
+    # fit on the leading columns of the landmark, views of the shared arrays
+    tic = time.perf_counter()
+    estimator.fit(X_train[:, :n_columns], y_train)
+    seconds = time.perf_counter() - tic
+
+    scores = estimator.predict_proba(X_test[:, :n_columns])[:, 1]
+    return estimator, cindex(y_test, scores), seconds
+
+
+@profiled
+def train_landmarks(
+    df,
+    estimator,
+    target="dropout",
+    landmarks=LANDMARKS,
+    sources=("test", "survey", "meds"),
+    static=(),
+    test_size=0.25,
+    random_state=0,
+    n_jobs=-1,
+):
+    """
+    Train and evaluate one dropout model per landmark week from one preprocessed cohort.
+    The feature matrix is built once (see landmark_matrix) and split once, every landmark
+    fits a clone of the estimator on its leading columns, in parallel, and is scored with
+    the C-index on the same held out patients.
+
+    Parameters:
+    df (pandas.DataFrame): The preprocessed wide table with the target.
+    estimator: Classifier with predict_proba, cloned for every landmark.
+    target (str): The target column.
+    landmarks (list): The landmark weeks, e.g. (1, 2, 4, 8, 12).
+    sources (list): Source tables of the weekly columns.
+    static (list): Columns known at baseline, included at every landmark.
+    test_size (float): Share of the patients held out for the C-index.
+    random_state (int): Seed of the split.
+    n_jobs (int): Number of parallel jobs, -1 uses all cores.
+
+    Returns:
+    dict: 'results' with the features, C-index and fit time per landmark, the fitted 'models'
+    and the 'columns' of each landmark.
+    """
+    from joblib import Parallel, delayed
+    from sklearn.base import clone
+    from sklearn.model_selection import train_test_split
+
+    X, columns, bounds = landmark_matrix(df, landmarks, sources, static)
+    y = df[target].to_numpy()
+
+    # one split shared by every landmark, the arrays are shared with the workers
+    train, test = train_test_split(np.arange(len(y)), test_size=test_size, stratify=y, random_state=random_state)
+    X_train, X_test = np.asfortranarray(X[train]), np.asfortranarray(X[test])
+
+    fitted = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_landmark)(clone(estimator), X_train, y[train], X_test, y[test], n)
+        for n in bounds.values()
+    )
+
+    results = pd.DataFrame(
+        {
+            "landmark": list(bounds),
+            "n_features": list(bounds.values()),
+            "cindex": [score for _, score, _ in fitted],
+            "fit_seconds": [round(seconds, 3) for _, _, seconds in fitted],
+        }
+    ).set_index("landmark")
+    print(results)
+
+    return {
+        "results": results,
+        "models": {week: model for week, (model, _, _) in zip(bounds, fitted)},
+        "columns": {week: columns[:n] for week, n in bounds.items()},
+    }
+
+
+def model_digest(model):
+    """
+    Hash a fitted model by its pickled state, so explanations are tied to the exact model.
+
+    Parameters:
+    model: The fitted model.
+
+    Returns:
+    str: The hex digest of the model.
+    """
+    import pickle
+
+    return hashlib.sha256(pickle.dumps(model)).hexdigest()
+
+
+@profiled
+def explain_model(
+    model,
+    X,
+    background,
+    feature_names=None,
+    max_background=100,
+    batch_size=256,
+    random_state=0,
+    cache_dir=CACHE_DIR,
+):
+    """
+    Compute SHAP values in batches against a bounded background sample, and persist them keyed
+    on the model and the data. A repeated call with the same model and rows loads the values
+    from the cache, and a call with a single patient row only explains that row.
+
+    Parameters:
+    model: The fitted model, e.g. the XGBClassifier of the pipeline.
+    X (array-like): The rows to explain, already preprocessed.
+    background (array-like): Rows used as background data, e.g. the preprocessed training set.
+    feature_names (list, optional): Names of the features.
+    max_background (int): Largest number of background rows, sampled without replacement.
+    batch_size (int): Rows explained per batch.
+    random_state (int): Seed for the background sample.
+    cache_dir (str): Directory of the cached explanations.
+
+    Returns:
+    shap.Explanation: The SHAP values, base values and data of every row.
+    """
+    import shap
+
+    X = X.toarray() if hasattr(X, "toarray") else np.asarray(X)
+    background = background.toarray() if hasattr(background, "toarray") else np.asarray(background)
+
+    # bounded background sample
+    if len(background) > max_background:
+        rows = np.random.RandomState(random_state).choice(len(background), max_background, replace=False)
+        background = background[np.sort(rows)]
+
+    digest = hashlib.sha256(model_digest(model).encode())
+    _update_digest(digest, [X, background, list(feature_names) if feature_names is not None else None])
+    path = os.path.join(cache_dir, f"shap-{digest.hexdigest()[:20]}.npz")
+
+    if os.path.exists(path):
+        os.utime(path)
+        cached = np.load(path, allow_pickle=False)
+        values, base_values = cached["values"], cached["base_values"]
+    else:
+        explainer = shap.Explainer(model, background)
+        values, base_values = [], []
+        for start in range(0, len(X), batch_size):
+            batch = explainer(X[start : start + batch_size])
+            values.append(batch.values)
+            base_values.append(np.broadcast_to(batch.base_values, batch.values.shape[:1] + np.shape(batch.base_values)[1:]))
+        values, base_values = np.concatenate(values), np.concatenate(base_values)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, values=values, base_values=base_values)
+
+    return shap.Explanation(
+        values=values,
+        base_values=base_values,
+        data=X,
+        feature_names=list(feature_names) if feature_names is not None else None,
+    )
+
+
+def patient_explanation(explanation, index, max_display=10):
+    """
+    Data behind the waterfall and force plots of one patient: the features with the largest
+    SHAP values, the remaining features summed into one row, the base value and the model output.
+
+    Parameters:
+    explanation (shap.Explanation): The explanation from explain_model.
+    index (int): Position of the patient in the explained rows.
+    max_display (int): Number of features listed individually.
+
+    Returns:
+    pandas.DataFrame: 'feature', 'value' and 'shap_value' sorted by impact, with the base value
+    and the model output in the frame's attrs.
+    """
+    row = explanation[index]
+    names = row.feature_names or [f"Feature {i}" for i in range(len(row.values))]
+
+    df = pd.DataFrame({"feature": names, "value": row.data, "shap_value": row.values})
+    df = df.reindex(df["shap_value"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+
+    # sum the features that are not listed individually
+    if len(df) > max_display:
+        rest = df.iloc[max_display - 1 :]
+        other = pd.DataFrame(
+            {"feature": [f"{len(rest)} other features"], "value": [np.nan], "shap_value": [rest["shap_value"].sum()]}
+        )
+        df = pd.concat([df.iloc[: max_display - 1], other], ignore_index=True)
+
+    base_value = float(np.ravel(row.base_values)[0])
+    df.attrs["base_value"] = base_value
+    df.attrs["output"] = base_value + float(row.values.sum())
+
+    return df
+
+
+def dependence_slice(explanation, feature, interaction=None):
+    """
+    The data behind a SHAP dependence plot for one feature, read from the explanation
+    without copying the other features.
+
+    Parameters:
+    explanation (shap.Explanation): The explanation from explain_model.
+    feature (str): The feature on the x axis.
+    interaction (str, optional): The feature used to color the points.
+
+    Returns:
+    pandas.DataFrame: The feature value, its SHAP value, and the interaction feature value.
+    """
+    names = list(explanation.feature_names)
+    i = names.index(feature)
+
+    df = pd.DataFrame({feature: explanation.data[:, i], "shap_value": explanation.values[:, i]})
+    if interaction is not None:
+        df[interaction] = explanation.data[:, names.index(interaction)]
+
+    return df
+
+
+def feature_clustering(X, y, cache_dir=CACHE_DIR):
+    """
+    Hierarchical clustering of the features for the SHAP bar plot, computed once per
+    dataset and loaded from the stage cache afterwards.
+
+    Parameters:
+    X (pandas.DataFrame): The features.
+    y (array-like): The labels.
+    cache_dir (str): The cache directory.
+
+    Returns:
+    numpy.ndarray: The clustering, as returned by shap.utils.hclust.
+    """
+    import shap
+
+    return cached_stage(shap.utils.hclust, X, y, cache_dir=cache_dir)
@@ -0,0 +1,453 @@
+"""
+Weekly charts and model plots. matplotlib, seaborn and shap are imported on first use.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .etl import column_index, select_columns
+from .modelling import dependence_slice
+from .profiling import profiled
+
+
+def series_func(df, group, agg="mean"):
+    """
+    Create series from wide dataset, by specifying the
+    data category your are looking for.
+
+    Parameters:
+    df: pandas dataframe, data to be aggregated
+    group: str, data category e.g. 'test_opiate300'
+    agg: str, aggregation function
+
+    Returns:
+    pandas series, the aggregate for each week, indexed by week
+
+    """
+    # subset columns for data group specified
+    source, _, measure = group.partition("_")
+    cols = select_columns(df, source, [measure] if measure else None)
+    cols = [col for col in cols if not np.isnan(column_index(df).at[col, "week"])]
+
+    # index the columns by week
+    df = df[cols]
+    df.columns = column_index(df)["week"].astype(int).to_numpy()
+
+    # create condition for aggregation
+    if agg == "mean":
+        series = df.mean()
+    elif agg == "sum":
+        series = df.sum()
+
+    return series
+
+
+def plot_func(series, title, ylabel, xlabel):
+    """
+    Plot the data series.
+
+    Parameters:
+    series: pandas series, data series to plot
+    title: str, title of the plot
+
+    Returns:
+
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    fig = plt.figure(figsize=(14, 4))
+    # take input to plot in a loop with subplots
+    sns.barplot(x=series.index, y=series.values.flatten(), color="gray")
+    plt.axhline(y=series.mean(), color="black", linestyle="--")
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+
+
+def draw_weekly(ax, series, drug, group):
+    """
+    Draw the weekly bar chart of one drug class on the given axes, with the mean line
+    and the annotation used in the project plots.
+
+    Parameters:
+    ax: matplotlib Axes to draw on
+    series: pandas Series, weekly values indexed by week
+    drug: str, full drug name
+    group: str, data category 'test_' or 'survey_'
+
+    Returns:
+
+    """
+    import seaborn as sns
+    # create condition for survey vs. tests
+    if group == "survey_":
+        title = f"{drug.capitalize()} Monthly Instance of Self Reported Drug Use"
+        note = f"Monthly average of {round(series.mean(), 2)} reported instances of {drug.capitalize()} use"
+    else:
+        title = f"{drug.capitalize()} Drug Screen: Positive Test Rate"
+        note = f"Weekly average {round(series.mean(), 2)} positive test rate"
+
+    # the next steps create the plot, apply annotation to project the insights to the user
+    sns.barplot(x=series.index, y=series.values, color="gray", ax=ax)  # use seaborn to create a barplot
+    ax.axhline(series.mean(), color="red", linestyle="--", linewidth=1)  # Add mean to show change from central tendency
+    ax.annotate(  # create a small text box showing a float with positive test rate
+        note,
+        xy=(0.5, 0.5),
+        xycoords="axes fraction",
+        ha="center",
+        va="center",
+        fontsize=12,
+        color="black",
+        backgroundcolor="white",
+    )
+
+    # Add plot titles and labels
+    ax.set_title(title)
+    ax.set_xlabel("Week of Treatment")
+    ax.set_ylabel("Number of Positive Tests")
+
+
+def plot_weekly_data(df, drug_dict, group):
+    """
+    This function plots the weekly data for each drug class.
+
+    Parameters:
+    df: pandas DataFrame, data to be plotted
+    drug_dict: dict, dictionary with drug acronyms as keys and drug names as values
+
+    Returns:
+
+    """
+    import matplotlib.pyplot as plt
+    # iterate through list of drug test names
+    for col in df.columns:
+        plt.figure(figsize=(14, 4))
+        draw_weekly(plt.gca(), df[col], drug_dict[col], group)
+        plt.show()  # Display the plot
+
+
+@profiled
+def weekly_table(df, group, agg="mean", by=None):
+    """
+    Aggregate the weekly columns of a data group for every drug class in one pass, optionally
+    for every value of a grouping column, e.g. the site or the study arm.
+
+    Parameters:
+    df: pandas DataFrame, data to be aggregated
+    group: str, data category e.g 'test_', 'survey_'
+    agg: str, aggregation function e.g. 'sum', 'mean', survey data is always summed
+    by: str, optional column to aggregate each of its values separately
+
+    Returns:
+    tuple: (weeks x drug acronyms DataFrame, or a dict of them keyed by the values of `by`,
+    dict with drug acronyms as keys and drug names as values)
+    """
+    # survey data is reported as instances of use, which are summed
+    if group == "survey_":
+        agg = "sum"
+
+    # weekly columns of the group, with their drug and week from the column index
+    index = column_index(df)
+    index = index.loc[select_columns(df, group)]
+    index = index.loc[index["week"].notna()]
+
+    # the drug names in order of appearance, e.g. test_opiate300_1 gives opiate300
+    drug_cols = index["measure"].unique().tolist()
+
+    # create acronyms for drugs in dataframe for easier reading
+    # an example would be transform Opiate300 to opi
+    # provides easier reading for the dataframe
+    # drugs sharing an acronym, e.g. methadone and methamphetamine, keep their full names
+    acronym_cols = [col.lower()[:3] for col in drug_cols]
+    acronym_cols = [col if acronym_cols.count(acronym) > 1 else acronym for col, acronym in zip(drug_cols, acronym_cols)]
+    drug_dict = dict(zip(acronym_cols, drug_cols))
+
+    # aggregate every column at once, one row per value of `by`
+    cols = index.index.tolist()
+    values = df[cols].agg(agg).to_frame("all").T if by is None else df.groupby(by)[cols].agg(agg)
+
+    # lay the values out as weeks x (group, drug)
+    values = values.T
+    values.index = pd.MultiIndex.from_arrays(
+        [index["week"].astype(int).to_numpy(), index["measure"].map(dict(zip(drug_cols, acronym_cols))).to_numpy()]
+    )
+    table = values.unstack().round(2)
+
+    tables = {}
+    for key in values.columns:
+        tables[key] = table[key][acronym_cols].rename_axis(index=None, columns=None)
+
+    return (tables["all"] if by is None else tables), drug_dict
+
+
+def agg_weekly_data(df, group, agg, plot=True):
+    """
+    This function aggregates the weekly data for a specified group of data.
+    The aggregated data will be organized in a dataframe, ideal for plotting
+    and extracting meaningful insights.
+
+    Parameters:
+    df: pandas DataFrame, data to be aggregated
+    group: str, data category e.g 'test', 'meds'
+    agg: str, aggregation function e.g. 'sum', 'mean'
+    plot: bool, plot each drug class, set to False in scripts and reports
+
+    Returns:
+    pandas DataFrame
+
+    """
+    merged_df, drug_dict = weekly_table(df, group, agg)
+
+    print("Series created for each drug class:", ", ".join(merged_df.columns))
+    print()
+    print("drug_tests Dataframe:  Positive test rate per drug class")
+
+    if plot:
+        plot_weekly_data(merged_df, drug_dict, group)
+
+    return merged_df, drug_dict
+
+
+def _render_weekly(series, drug, group, path, dpi=100):
+    """
+    Render one weekly chart to an image file, without pyplot so it runs in any process.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(14, 4))
+    draw_weekly(fig.subplots(), series, drug, group)
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+    return path
+
+
+def _render_panel(table, drug_dict, group, path, ncols=3, dpi=100):
+    """
+    Render every drug class of a weekly table as small multiples in one image file.
+    """
+    from matplotlib.figure import Figure
+
+    nrows = int(np.ceil(len(table.columns) / ncols))
+    fig = Figure(figsize=(7 * ncols, 3.5 * nrows))
+    axes = np.atleast_1d(fig.subplots(nrows, ncols, squeeze=False)).ravel()
+    for ax, col in zip(axes, table.columns):
+        draw_weekly(ax, table[col], drug_dict[col], group)
+    for ax in axes[len(table.columns) :]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+    return path
+
+
+@profiled
+def render_weekly_report(
+    df,
+    output_dir,
+    groups=("test_", "survey_"),
+    agg="mean",
+    by=None,
+    panel=True,
+    max_workers=None,
+    dpi=100,
+):
+    """
+    Render the weekly drug charts to image files without a notebook or a display. The weekly
+    aggregates are computed in one grouped pass per data group, then every chart is drawn on a
+    non-interactive figure across a pool of worker processes.
+
+    Files are written as output_dir/[by value/]group_drug.png, plus one group_panel.png with the
+    small multiples of every drug class when panel is set.
+
+    Parameters:
+    df: pandas DataFrame, the wide feature table
+    output_dir: str, directory for the images
+    groups: list, data categories to render, e.g. ['test_', 'survey_']
+    agg: str, aggregation function for the tests, survey data is always summed
+    by: str, optional column to render a report for each of its values, e.g. the site
+    panel: bool, also render the small multiples panel per data group
+    max_workers: int, number of worker processes, defaults to the number of cores
+    dpi: int, resolution of the images
+
+    Returns:
+    list: The paths of the rendered images.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = []
+    for group in groups:
+        tables, drug_dict = weekly_table(df, group, agg, by)
+        tables = {None: tables} if by is None else tables
+
+        for key, table in tables.items():
+            folder = output_dir if key is None else os.path.join(output_dir, str(key))
+            os.makedirs(folder, exist_ok=True)
+            for col in table.columns:
+                path = os.path.join(folder, f"{group}{drug_dict[col]}.png")
+                jobs.append((_render_weekly, (table[col], drug_dict[col], group, path, dpi)))
+            if panel:
+                path = os.path.join(folder, f"{group}panel.png")
+                jobs.append((_render_panel, (table, drug_dict, group, path, 3, dpi)))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(func, *args) for func, args in jobs]
+        paths = [future.result() for future in futures]
+
+    return paths
+
+
+# create a function to plot confusionmatrixdisplay for each classifier
+def plot_confusion_matrix(
+    y_true, y_pred, classes, normalize=False, title=None, cmap="Blues"
+):
+    """
+    This function prints and plots the confusion matrix.
+    Normalization can be applied by setting `normalize=True`.
+    """
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import confusion_matrix
+
+    if not title:
+        if normalize:
+            title = "Normalized confusion matrix"
+        else:
+            title = "Confusion matrix, without normalization"
+
+    # Compute confusion matrix
+    cm = confusion_matrix(y_true, y_pred)
+    if normalize:
+        cm = cm.astype("float") / cm.sum(axis=1)[:, np.newaxis]
+    else:
+        pass
+    fig, ax = plt.subplots()
+    im = ax.imshow(cm, interpolation="nearest", cmap=cmap)
+    ax.figure.colorbar(im, ax=ax)
+    # We want to show all ticks...
+    ax.set(
+        xticks=np.arange(cm.shape[1]),
+        yticks=np.arange(cm.shape[0]),
+        # ... and label them with the respective list entries
+        xticklabels=classes,
+        yticklabels=classes,
+        title=title,
+        ylabel="True label",
+        xlabel="Predicted label",
+    )
+
+    # Rotate the tick labels and set their alignment.
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right", rotation_mode="anchor")
+
+    # Loop over data dimensions and create text annotations.
+    fmt = ".2f" if normalize else "d"
+    thresh = cm.max() / 2.0
+    for i in range(cm.shape[0]):
+        for j in range(cm.shape[1]):
+            ax.text(
+                j,
+                i,
+                format(cm[i, j], fmt),
+                ha="center",
+                va="center",
+                color="white" if cm[i, j] > thresh else "black",
+            )
+    fig.tight_layout()
+    return ax
+
+
+def plot_feature_importance(model, preprocessor, X, metric="gain", num_features=25):
+    """
+    Plot the feature importance of a model.
+
+    Parameters:
+    - model: The trained model.
+    - preprocessor: The preprocessing ColumnTransformer.
+    - X: The input features.
+    - metric: The feature importance metric to use (default: 'gain').
+    - num_features: The number of top features to plot (default: 25).
+
+    Returns:
+    - None (plots the feature importance).
+    """
+    import matplotlib.pyplot as plt
+    # Get feature importances
+    importances = model.get_booster().get_score(importance_type=metric)
+
+    # Extract feature names from the preprocessor
+    feature_names = []
+
+    for name, transformer, columns in preprocessor.transformers_:
+        if hasattr(transformer, "categories_"):
+            # OneHotEncoder case
+            for i, cat in enumerate(transformer.categories_):
+                feature_names.extend([f"{columns[i]}_{category}" for category in cat])
+        else:
+            feature_names.extend(columns)
+
+    # Map feature indices to feature names
+    importances_named = {feature_names[int(k[1:])]: v for k, v in importances.items()}
+
+    # Round importances
+    importances_rounded = {k: round(v, 2) for k, v in importances_named.items()}
+
+    # Sort features by importance
+    sorted_importances = sorted(
+        importances_rounded.items(), key=lambda x: x[1], reverse=True
+    )[:num_features]
+
+    # Create DataFrame for plotting
+    importance_df = pd.DataFrame(sorted_importances, columns=["Feature", "Importance"])
+
+    # Plot the feature importances
+    plt.figure(figsize=(10, 6))
+    bars = plt.barh(importance_df["Feature"], importance_df["Importance"])
+    plt.xlabel("Importance")
+    plt.ylabel("Feature")
+    plt.title(f"Feature Importance - Gain")
+    plt.gca().invert_yaxis()  # Invert y-axis to have the most important feature at the top
+
+    # Annotate the bars with the importance values
+    for bar in bars:
+        plt.text(
+            bar.get_width(),
+            bar.get_y() + bar.get_height() / 2,
+            f"{bar.get_width():.2f}",
+            va="center",
+        )
+
+    plt.show()
+
+    return importance_df
+
+
+def plot_dependence(explanation, pairs):
+    """
+    Create SHAP dependence plots side by side, one per (feature, interaction) pair, from the
+    cached explanation of explain_model. Only the plotted columns are read from it.
+
+    Parameters:
+    - explanation: The shap.Explanation from helper.explain_model, with feature names.
+    - pairs: List of (feature, interaction) names, e.g. [('cows_postdose', 'meds_methadone_2')],
+      the interaction feature colors the points and may be None.
+
+    Returns:
+    - None: This function displays the dependence plots.
+    """
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, len(pairs), figsize=(7.5 * len(pairs), 5), squeeze=False)
+
+    for ax, (feature, interaction) in zip(axes[0], pairs):
+        df = dependence_slice(explanation, feature, interaction)
+        if interaction is None:
+            ax.scatter(df[feature], df["shap_value"], s=12, color="#1E88E5")
+        else:
+            points = ax.scatter(df[feature], df["shap_value"], s=12, c=df[interaction], cmap="coolwarm")
+            fig.colorbar(points, ax=ax, label=interaction)
+        ax.axhline(0, color="grey", linewidth=0.5)
+        ax.set_xlabel(feature)
+        ax.set_ylabel(f"SHAP value for {feature}")
+        ax.set_title(f"Dependence Plot for {feature}")
+
+    plt.tight_layout()
+    plt.show()
@@ -0,0 +1,273 @@
+"""
+Opt-in timing and memory instrumentation of the helpers and pipeline stages.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# stage instrumentation, disabled unless enable_profiling is called
+_PROFILE = {"enabled": False, "memory": True, "tracing": False, "path": None, "run": None, "records": []}
+
+
+# stages being recorded, per thread; the counts of merges and pivots live on the frames
+_PROFILE_STACK = threading.local()
+
+
+_PROFILE_OPERATIONS = ("pivots", "merges")
+
+
+# threads with a stage being recorded, tracemalloc's peak is only reset when no other thread has one
+_PROFILE_THREADS = set()
+
+
+_PROFILE_LOCK = threading.Lock()
+
+
+def enable_profiling(path=None, memory=True, run=None):
+    """
+    Start recording every instrumented helper call of the current pipeline run.
+
+    Parameters:
+    path (str, optional): JSON lines file the records are appended to as they finish, its
+    directory is created when missing.
+    memory (bool): Trace allocations with tracemalloc for the peak and incremental memory,
+    this slows numpy heavy code down a little.
+    run (str, optional): Name of the run stored on every record, the start time by default.
+    """
+    import tracemalloc
+
+    if path is not None and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # only stop tracemalloc on disable when it was started here
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    _PROFILE.update(
+        enabled=True,
+        memory=memory,
+        tracing=tracing,
+        path=path,
+        run=run or time.strftime("%Y%m%d-%H%M%S"),
+        records=[],
+    )
+
+
+def disable_profiling():
+    """
+    Stop recording and return the records of the run.
+
+    Returns:
+    list: One dict per instrumented call, in the order the calls finished.
+    """
+    import tracemalloc
+
+    if _PROFILE["tracing"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _PROFILE.update(enabled=False, tracing=False)
+    return _PROFILE["records"]
+
+
+def count_operation(name):
+    """
+    Count a merge or pivot, reported on the records of every enclosing stage of the thread.
+    """
+    if _PROFILE["enabled"]:
+        stack = getattr(_PROFILE_STACK, "frames", None)
+        if stack:
+            stack[-1]["counts"][name] += 1
+
+
+def _frame_shape(obj):
+    # shape of the first dataframe-like argument or of the result, lists use their first table
+    if isinstance(obj, (list, tuple)) and obj:
+        obj = obj[0]
+    shape = getattr(obj, "shape", None)
+    if shape is None:
+        return None, None
+    return shape[0], shape[1] if len(shape) > 1 else 1
+
+
+@contextlib.contextmanager
+def profile_stage(name, data=None):
+    """
+    Record a block of pipeline code as one stage, nested stages and instrumented helpers
+    inside it are recorded as its children. Costs a single check when profiling is disabled.
+
+    Stages are nested per thread, e.g. the read_table calls of load_tables are recorded at
+    the top level of their worker threads. tracemalloc only has one process wide peak: while
+    stages run in other threads it is not reset, so the peak memory of a stage is then the
+    peak of the process since the last reset, not of the stage alone.
+
+    Parameters:
+    name (str): Name of the stage, e.g. 'uds'.
+    data (optional): Input table reported as the stage's rows and columns.
+
+    Example:
+    with helper.profile_stage("uds", uds):
+        uds_flat = helper.flatten_dataframe(uds, 0, 24, 1)
+    """
+    if not _PROFILE["enabled"]:
+        yield
+        return
+
+    import tracemalloc
+
+    stack = _PROFILE_STACK.__dict__.setdefault("frames", [])
+    memory = _PROFILE["memory"] and tracemalloc.is_tracing()
+    frame = {"peak": 0, "counts": dict.fromkeys(_PROFILE_OPERATIONS, 0)}
+    thread = threading.get_ident()
+    with _PROFILE_LOCK:
+        _PROFILE_THREADS.add(thread)
+        start_memory = tracemalloc.get_traced_memory()[0] if memory else 0
+        if memory and _PROFILE_THREADS == {thread}:
+            # fold the peak so far into the parent before the peak is reset for this stage
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+    stack.append(frame)
+    path = ";".join([f["name"] for f in stack[:-1]] + [name])
+    frame["name"] = name
+    start = time.perf_counter()
+    try:
+        yield frame
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        with _PROFILE_LOCK:
+            if not stack:
+                _PROFILE_THREADS.discard(thread)
+            current, peak = tracemalloc.get_traced_memory() if memory else (0, 0)
+        peak = max(peak, frame["peak"])
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            for operation, count in frame["counts"].items():
+                stack[-1]["counts"][operation] += count
+        rows_in, cols_in = _frame_shape(data)
+        rows_out, cols_out = _frame_shape(frame.get("result"))
+        record = {
+            "run": _PROFILE["run"],
+            "stage": path,
+            "name": name,
+            "depth": len(stack),
+            "seconds": round(seconds, 6),
+            "peak_mb": round((peak - start_memory) / 1e6, 3) if memory else None,
+            "delta_mb": round((current - start_memory) / 1e6, 3) if memory else None,
+            "rows_in": rows_in,
+            "cols_in": cols_in,
+            "rows_out": rows_out,
+            "cols_out": cols_out,
+            **frame["counts"],
+        }
+        with _PROFILE_LOCK:
+            _PROFILE["records"].append(record)
+            if _PROFILE["path"]:
+                with open(_PROFILE["path"], "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+def profiled(func):
+    """
+    Decorator recording every call of a helper as a stage when profiling is enabled, with its
+    first dataframe argument as input and its result as output.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _PROFILE["enabled"]:
+            return func(*args, **kwargs)
+        with profile_stage(func.__name__, args[0] if args else None) as frame:
+            frame["result"] = func(*args, **kwargs)
+            return frame["result"]
+
+    return wrapper
+
+
+def profile_summary(records=None):
+    """
+    Summarise the records of a run per stage.
+
+    Parameters:
+    records (list or str, optional): Records, or a JSON lines file. Defaults to the current run.
+
+    Returns:
+    pandas.DataFrame: Calls, total, self and mean seconds, share of the run time, the largest
+    peak memory and the merges/pivots per stage, slowest first.
+    """
+    df = _profile_records(records)
+    df["self_seconds"] = df["seconds"] - _child_seconds(df)
+    total = df.loc[df["depth"] == 0, "seconds"].sum()
+
+    summary = df.groupby("stage").agg(
+        calls=("seconds", "size"),
+        seconds=("seconds", "sum"),
+        self_seconds=("self_seconds", "sum"),
+        mean_seconds=("seconds", "mean"),
+        peak_mb=("peak_mb", "max"),
+        pivots=("pivots", "sum"),
+        merges=("merges", "sum"),
+    )
+    summary["share"] = (summary["seconds"] / total).round(3) if total else np.nan
+
+    return summary.sort_values("seconds", ascending=False)
+
+
+def profile_flame(records=None, path=None):
+    """
+    Flame-style breakdown of a run: prints the stage tree with the time of every stage and
+    its share of the run, and writes the folded stacks ('a;b;c microseconds') read by
+    flamegraph.pl and speedscope.
+
+    Parameters:
+    records (list or str, optional): Records, or a JSON lines file. Defaults to the current run.
+    path (str, optional): File for the folded stacks.
+
+    Returns:
+    list: The folded stack lines, weighted by self time in microseconds.
+    """
+    df = _profile_records(records)
+    df["self_seconds"] = df["seconds"] - _child_seconds(df)
+    total = df.loc[df["depth"] == 0, "seconds"].sum() or 1.0
+
+    tree = df.groupby("stage", sort=False).agg(seconds=("seconds", "sum"), self_seconds=("self_seconds", "sum"))
+    for stage, row in tree.sort_index().iterrows():
+        depth = stage.count(";")
+        bar = "#" * int(round(40 * row["seconds"] / total))
+        print(f"{'  ' * depth}{stage.split(';')[-1]:<{30 - 2 * depth}} {row['seconds']:9.3f} s {row['seconds'] / total:6.1%} {bar}")
+
+    folded = [f"{stage} {int(round(row['self_seconds'] * 1e6))}" for stage, row in tree.iterrows()]
+    if path:
+        with open(path, "w") as f:
+            f.write("\n".join(folded) + "\n")
+
+    return folded
+
+
+def _profile_records(records):
+    # records of the current run, a list of records or a JSON lines file as a dataframe
+    if records is None:
+        records = _PROFILE["records"]
+    elif isinstance(records, str):
+        with open(records) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records)
+
+
+def _child_seconds(df):
+    # time spent in the direct children of each record; a child finishes before its parent,
+    # so the children of a record are the records one level deeper since the last record at
+    # its own depth
+    child = np.zeros(len(df))
+    pending = {}
+    for i, depth in enumerate(df["depth"].to_numpy()):
+        child[i] = pending.pop(depth + 1, 0.0)
+        pending[depth] = pending.get(depth, 0.0) + df["seconds"].iat[i]
+    return child
@@ -0,0 +1,352 @@
+"""
+Memory-mapped feature store of the wide, one row per patient tables.
+
+A store is a directory of column-major .npy blocks, one per storage dtype, memory-mapped
+on open, and a metadata file with the column names, dtypes and block positions. Rows are
+found through the sorted 'patdeid' keys, so one patient or a few columns are read without
+parsing the table.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+STORE_VERSION = 1
+
+
+def _column_arrays(series):
+    """
+    Split a column into the arrays written to the store and the metadata to rebuild it.
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or dtype == object or isinstance(dtype, pd.StringDtype):
+        # strings are stored as category codes, -1 for missing values
+        values = series.astype("category")
+        meta = {"kind": "category", "dtype": str(dtype), "categories": values.cat.categories.tolist()}
+        return {"values": values.cat.codes.to_numpy()}, meta
+    if isinstance(series.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+        # nullable integers, floats and booleans: the values with missing ones as 0, and the mask
+        values = series.array.to_numpy(dtype=dtype.numpy_dtype, na_value=dtype.numpy_dtype.type(0))
+        meta = {"kind": "masked", "dtype": str(dtype)}
+        return {"values": values, "mask": series.isna().to_numpy()}, meta
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        raise TypeError(f"Column '{series.name}' of dtype {dtype} can't be written to a feature store")
+    return {"values": series.to_numpy()}, {"kind": "numpy", "dtype": str(dtype)}
+
+
+def _category_lookup(meta):
+    """
+    What the codes of a stored string column are decoded with: the categorical dtype, or for
+    object columns the categories with NaN last, so the -1 code of missing values picks it.
+    """
+    if meta["dtype"] == "object":
+        return np.array(meta["categories"] + [np.nan], dtype=object)
+    return pd.CategoricalDtype(meta["categories"])
+
+
+def _column_values(arrays, meta, categories=None):
+    """
+    Rebuild the values of a column from the (selected rows of the) stored arrays.
+    """
+    if meta["kind"] == "category":
+        categories = _category_lookup(meta) if categories is None else categories
+        if meta["dtype"] == "object":
+            return categories[arrays["values"]]
+        values = pd.Categorical.from_codes(arrays["values"], dtype=categories)
+        return values if meta["dtype"] == "category" else values.astype(meta["dtype"])
+    if meta["kind"] == "masked":
+        dtype = pd.api.types.pandas_dtype(meta["dtype"])
+        return dtype.construct_array_type()(arrays["values"], arrays["mask"])
+    return arrays["values"]
+
+
+def write_feature_store(df, path, key="patdeid"):
+    """
+    Write a one row per patient DataFrame to a memory-mapped feature store. Columns with the
+    same storage dtype are written as one column-major block, so a column is a contiguous
+    slice of its block file. The store is staged in a temporary directory next to the target
+    and renamed into place, an existing store is moved aside first and removed afterwards, so
+    a store is never left partially written and concurrent writers don't share files.
+
+    Parameters:
+    df (pandas.DataFrame): The table to store, with unique values in the key column.
+    path (str): Directory of the store, replaced when it exists.
+    key (str, optional): Numeric column of the row index, rows are looked up by position
+    when None.
+
+    Returns:
+    str: The path of the store.
+    """
+    if key is not None and (df[key].isna().any() or df[key].duplicated().any()):
+        raise ValueError(f"The '{key}' column must be unique and not null to index the store")
+
+    path = path.rstrip(os.sep)
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{os.path.basename(path)}.", dir=parent)
+    try:
+        _write_store(df, staging, key)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    # swap the stores with two renames, the old one is removed once the new one is in place
+    aside = None
+    if os.path.exists(path):
+        aside = f"{staging}.old"
+        os.rename(path, aside)
+    os.rename(staging, path)
+    if aside is not None:
+        shutil.rmtree(aside, ignore_errors=True)
+
+    return path
+
+
+def _write_store(df, staging, key):
+    """
+    Write the blocks, the key index and the metadata of a store into an empty directory.
+    """
+    # group the arrays of every column by storage dtype
+    columns = []
+    blocks = {}
+    for name in df.columns:
+        arrays, meta = _column_arrays(df[name])
+        meta["name"] = name
+        for part, values in arrays.items():
+            block = blocks.setdefault(values.dtype.str, [])
+            meta[part] = [values.dtype.str, len(block)]
+            block.append(values)
+        columns.append(meta)
+
+    block_files = {}
+    for i, (dtype, arrays) in enumerate(blocks.items()):
+        block_files[dtype] = f"block{i:03d}.npy"
+        block = np.empty((len(df), len(arrays)), dtype=dtype, order="F")
+        for j, values in enumerate(arrays):
+            block[:, j] = values
+        np.save(os.path.join(staging, block_files[dtype]), block, allow_pickle=False)
+    for meta in columns:
+        for part in ("values", "mask"):
+            if part in meta:
+                meta[part][0] = block_files[meta[part][0]]
+
+    # sorted keys and their rows, for binary search lookups
+    keys = np.arange(len(df)) if key is None else df[key].to_numpy()
+    order = np.argsort(keys, kind="stable")
+    np.save(os.path.join(staging, "index.keys.npy"), keys[order], allow_pickle=False)
+    np.save(os.path.join(staging, "index.rows.npy"), order.astype(np.int64), allow_pickle=False)
+
+    with open(os.path.join(staging, "store.json"), "w") as f:
+        json.dump({"version": STORE_VERSION, "key": key, "rows": len(df), "columns": columns}, f)
+
+
+class FeatureStore:
+    """
+    Read side of a feature store: block files are memory-mapped on first use, rows are
+    looked up by patient.
+
+    Examples:
+        store = helper.open_feature_store('../data/final_merged_data.store')
+        store.read(columns=['patdeid', 'dropout'])      # scan two columns
+        store.read(patients=[12, 40])                   # all columns of two patients
+        store.lookup(12)                                # one patient as a dict
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "store.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != STORE_VERSION:
+            raise ValueError(f"Unsupported feature store version {meta['version']} in {path}")
+
+        self.path = path
+        self.key = meta["key"]
+        self.n_rows = meta["rows"]
+        self.meta = {column["name"]: column for column in meta["columns"]}
+        self.columns = list(self.meta)
+        self._blocks = {}
+        self._categories = {}
+        self._keys = np.load(os.path.join(path, "index.keys.npy"), mmap_mode="r")
+        self._rows = np.load(os.path.join(path, "index.rows.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return f"FeatureStore({self.path!r}, rows={self.n_rows}, columns={len(self.columns)})"
+
+    def _block(self, file_name):
+        if file_name not in self._blocks:
+            self._blocks[file_name] = np.load(os.path.join(self.path, file_name), mmap_mode="r")
+        return self._blocks[file_name]
+
+    def rows(self, patients):
+        """
+        Positions of the patients' rows.
+
+        Parameters:
+        patients (array-like): Values of the key column, or row positions without a key.
+
+        Returns:
+        numpy.ndarray: Row positions, in the order of the patients.
+        """
+        patients = np.asarray(patients)
+        if len(self._keys) == 0:
+            if len(patients):
+                raise KeyError(f"Patients not in the store: {patients.tolist()}")
+            return np.empty(0, dtype=np.int64)
+        found = np.searchsorted(self._keys, patients)
+        found = np.minimum(found, len(self._keys) - 1)
+        missing = self._keys[found] != patients
+        if missing.any():
+            raise KeyError(f"Patients not in the store: {patients[missing].tolist()}")
+        return np.asarray(self._rows[found])
+
+    def _take(self, columns, rows):
+        """
+        Copy the selected rows of the blocks holding the columns, one read per block.
+        """
+        positions = {}
+        for name in columns:
+            for part in ("values", "mask"):
+                if part in self.meta[name]:
+                    file_name, position = self.meta[name][part]
+                    positions.setdefault(file_name, {})[position] = None
+
+        taken = {}
+        for file_name, block_positions in positions.items():
+            block = self._block(file_name)
+            block_positions = list(block_positions)
+            if len(block_positions) == block.shape[1]:
+                values = np.array(block if rows is None else block[rows])
+            else:
+                # column projection: only the selected slices of the block are read
+                values = np.array(block[:, block_positions] if rows is None else block[rows][:, block_positions])
+            taken[file_name] = (values, {position: i for i, position in enumerate(block_positions)})
+        return taken
+
+    def read(self, columns=None, patients=None):
+        """
+        Read the selected columns of the selected patients, only their blocks are touched.
+        Plain numpy columns of one block become one DataFrame block, and the decoding of string
+        columns is built once per store, so reading a few patients costs about one DataFrame
+        construction. For one patient as a dict, e.g. per request when scoring, use lookup.
+
+        Parameters:
+        columns (list, optional): Columns to read, all by default.
+        patients (array-like, optional): Patients to read, in this order, all rows by default.
+
+        Returns:
+        pandas.DataFrame: The selected part of the stored table.
+        """
+        columns = self.columns if columns is None else list(columns)
+        unknown = [name for name in columns if name not in self.meta]
+        if unknown:
+            raise KeyError(f"Columns not in the store: {unknown}")
+
+        rows = None if patients is None else self.rows(patients)
+        taken = self._take(columns, rows)
+
+        # plain numpy columns are sliced from their block together, the others one by one
+        plain = {}
+        frames = []
+        data = {}
+        for name in columns:
+            meta = self.meta[name]
+            if meta["kind"] == "numpy":
+                plain.setdefault(meta["values"][0], []).append(name)
+                continue
+            arrays = {}
+            for part in ("values", "mask"):
+                if part in meta:
+                    values, index = taken[meta[part][0]]
+                    arrays[part] = values[:, index[meta[part][1]]]
+            if meta["kind"] == "category" and name not in self._categories:
+                self._categories[name] = _category_lookup(meta)
+            data[name] = _column_values(arrays, meta, self._categories.get(name))
+
+        for file_name, names in plain.items():
+            values, index = taken[file_name]
+            positions = [index[self.meta[name]["values"][1]] for name in names]
+            frames.append(pd.DataFrame(values[:, positions], columns=names, copy=False))
+        if data:
+            frames.append(pd.DataFrame(data))
+        if not frames:
+            return pd.DataFrame(index=pd.RangeIndex(self.n_rows if rows is None else len(rows)))
+
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, axis=1, copy=False)
+        return df if list(df.columns) == columns else df[columns]
+
+    def lookup(self, patient, columns=None):
+        """
+        One patient's row as a dict, e.g. to score it with helper.score_rows.
+
+        Parameters:
+        patient: Value of the key column, or the row position without a key.
+        columns (list, optional): Columns to read, all by default.
+
+        Returns:
+        dict: Column name to value, missing values as NaN, NaT or None.
+        """
+        row = self.rows([patient])[0]
+        values = {}
+        result = {}
+        for name in self.columns if columns is None else columns:
+            meta = self.meta[name]
+            file_name, position = meta["values"]
+            if file_name not in values:
+                values[file_name] = self._block(file_name)[row].tolist()
+            value = values[file_name][position]
+            if meta["kind"] == "category":
+                value = meta["categories"][value] if value >= 0 else None
+            elif meta["kind"] == "masked":
+                file_name, position = meta["mask"]
+                if file_name not in values:
+                    values[file_name] = self._block(file_name)[row].tolist()
+                value = None if values[file_name][position] else value
+            elif meta["dtype"].startswith(("datetime64", "timedelta64")):
+                # tolist gives integers for nanosecond dates, read the typed value instead
+                value = pd.Series(self._block(file_name)[row : row + 1, position]).iloc[0]
+            result[name] = value
+        return result
+
+
+def open_feature_store(path):
+    """
+    Open a feature store written by write_feature_store or merge_dfs.
+
+    Parameters:
+    path (str): Directory of the store.
+
+    Returns:
+    FeatureStore: The memory-mapped store.
+    """
+    return FeatureStore(path)
+
+
+def load_features(csv_path, columns=None, patients=None, key="patdeid"):
+    """
+    Read a wide feature table through its feature store, a directory next to the csv file
+    with the '.store' extension. The store is built from the csv file on first use and
+    rebuilt when the csv file is newer, later reads skip the csv parsing.
+
+    Parameters:
+    csv_path (str): Path of the csv file, e.g. '../data/42_features.csv'.
+    columns (list, optional): Columns to read, all by default.
+    patients (array-like, optional): Patients to read, all by default.
+    key (str): Column of the row index, tables without it are indexed by row position.
+
+    Returns:
+    pandas.DataFrame: The selected part of the table.
+    """
+    path = os.path.splitext(csv_path)[0] + ".store"
+    meta = os.path.join(path, "store.json")
+    if not os.path.exists(meta) or os.path.getmtime(meta) < os.path.getmtime(csv_path):
+        df = pd.read_csv(csv_path)
+        write_feature_store(df, path, key if key in df.columns else None)
+
+    return open_feature_store(path).read(columns, patients)
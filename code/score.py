@@ -0,0 +1,306 @@
+"""
+Score patients with a persisted dropout model bundle (see helper.save_model_bundle).
+
+The bundle is loaded once, then patients are scored either from a csv file in batches,
+or by a small HTTP server on localhost that groups concurrent requests into micro-batches.
+
+Examples:
+    python score.py ../models/dropout.joblib ../data/42_features.csv --output ../data/scores.csv
+    python score.py ../models/dropout.joblib --serve --port 8000
+    python score.py ../models/dropout.joblib --store ../data/final_merged_data.store --patients 12 40
+
+    curl -X POST localhost:8000/score -d '[{"cows_postdose": 4, "meds_methadone_0": 30}]'
+    curl -X POST localhost:8000/score -d '[12, {"patdeid": 40}]'    # with --serve --store
+    curl localhost:8000/stats
+"""
+
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import helper
+
+
+class LatencyStats:
+    """
+    Thread safe record of scored rows and recent request latencies.
+    """
+
+    def __init__(self, size=10000):
+        self.latencies = collections.deque(maxlen=size)
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, seconds, rows):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.rows += rows
+
+    def summary(self):
+        """
+        Returns:
+        dict: Rows scored, throughput in rows per second since the start, and p50/p99
+        latency in milliseconds of the recent requests.
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            rows = self.rows
+        elapsed = time.perf_counter() - self.started
+        return {
+            "rows": rows,
+            "rows_per_second": round(rows / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3) if len(latencies) else None,
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3) if len(latencies) else None,
+        }
+
+
+class MicroBatcher:
+    """
+    Collects rows from concurrent requests and scores them together, a batch is scored when
+    it reaches max_batch rows or when the oldest request has waited max_wait seconds. When
+    scoring a batch fails, its requests are scored one by one, so only the bad ones fail.
+    """
+
+    def __init__(self, bundle, max_batch=256, max_wait=0.002):
+        self.bundle = bundle
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def score(self, rows):
+        """
+        Score the rows of one request, blocking until its batch is scored.
+        """
+        done = threading.Event()
+        request = {"rows": rows, "done": done, "scores": None, "error": None}
+        self.requests.put(request)
+        done.wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["scores"]
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0]["rows"])
+            deadline = time.perf_counter() + self.max_wait
+
+            # gather more requests until the batch is full or the wait is over
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request["rows"])
+
+            self._score_batch(batch)
+            for request in batch:
+                request["done"].set()
+
+    def _score_batch(self, batch):
+        try:
+            scores = helper.score_rows(self.bundle, [row for request in batch for row in request["rows"]])
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0]["error"] = error
+                return
+            # one bad request must not fail the others, score each request on its own
+            for request in batch:
+                self._score_batch([request])
+            return
+
+        start = 0
+        for request in batch:
+            request["scores"] = scores[start : start + len(request["rows"])].tolist()
+            start += len(request["rows"])
+
+
+def resolve_rows(rows, store):
+    """
+    Replace the rows given only by patient, e.g. 12 or {"patdeid": 12}, by the patient's row
+    in the feature store (see helper.open_feature_store). Unknown patients raise a KeyError.
+    """
+    resolved = []
+    for row in rows:
+        if not isinstance(row, dict):
+            row = {store.key: row}
+        if list(row) == [store.key]:
+            row = store.lookup(row[store.key])
+        resolved.append(row)
+    return resolved
+
+
+def make_handler(batcher, stats, store=None):
+    """
+    Build the request handler: POST /score with a JSON list of patient rows (or one row)
+    returns {"dropout_probability": [...]}, GET /stats returns the throughput and latency.
+    With a feature store, rows can also be given by patient only.
+    """
+
+    class ScoreHandler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, stats.summary())
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, {"error": "not found"})
+                return
+
+            start = time.perf_counter()
+            try:
+                rows = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                rows = [rows] if isinstance(rows, (dict, int)) else rows
+                rows = resolve_rows(rows, store) if store is not None else rows
+                scores = batcher.score(rows)
+            except (ValueError, KeyError, TypeError) as error:
+                stats.add(time.perf_counter() - start, 0)
+                self._send(400, {"error": str(error)})
+                return
+            except Exception as error:  # e.g. a model or bundle failure passed on by the batcher
+                stats.add(time.perf_counter() - start, 0)
+                self._send(500, {"error": f"{type(error).__name__}: {error}"})
+                return
+
+            stats.add(time.perf_counter() - start, len(rows))
+            self._send(200, {"dropout_probability": scores})
+
+        def log_message(self, format, *args):
+            # keep the console quiet, latency is reported by /stats
+            pass
+
+    return ScoreHandler
+
+
+def serve(bundle, host="127.0.0.1", port=8000, max_batch=256, max_wait=0.002, store=None):
+    """
+    Run the scoring server until interrupted.
+    """
+    stats = LatencyStats()
+    handler = make_handler(MicroBatcher(bundle, max_batch, max_wait), stats, store)
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Scoring server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(stats.summary())
+
+
+def score_file(bundle, input_path, output_path=None, batch_size=1024):
+    """
+    Score every row of a csv file in batches and report the throughput and batch latency.
+
+    Returns:
+    pandas.DataFrame: 'patdeid' when present and 'dropout_probability'.
+    """
+    df = pd.read_csv(input_path)
+    stats = LatencyStats()
+
+    scores = []
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start : start + batch_size]
+        tic = time.perf_counter()
+        scores.append(helper.score_rows(bundle, batch))
+        stats.add(time.perf_counter() - tic, len(batch))
+
+    result = pd.DataFrame({"dropout_probability": np.concatenate(scores) if scores else []}, index=df.index)
+    if "patdeid" in df.columns:
+        result.insert(0, "patdeid", df["patdeid"])
+
+    if output_path:
+        result.to_csv(output_path, index=False)
+    print(stats.summary())
+
+    return result
+
+
+def score_patients(bundle, store, patients=None, output_path=None, batch_size=1024):
+    """
+    Score patients of a feature store in batches, reading only the model's columns.
+
+    Returns:
+    pandas.DataFrame: The store key, e.g. 'patdeid', and 'dropout_probability'.
+    """
+    columns = [col for col in bundle["columns"] if col in store.columns]
+    if store.key is not None and store.key not in columns:
+        columns.append(store.key)
+    df = store.read(columns, patients)
+    stats = LatencyStats()
+
+    scores = []
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start : start + batch_size]
+        tic = time.perf_counter()
+        scores.append(helper.score_rows(bundle, batch))
+        stats.add(time.perf_counter() - tic, len(batch))
+
+    result = pd.DataFrame({"dropout_probability": np.concatenate(scores) if scores else []}, index=df.index)
+    if store.key is not None:
+        result.insert(0, store.key, df[store.key])
+
+    if output_path:
+        result.to_csv(output_path, index=False)
+    print(stats.summary())
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score patients with a dropout model bundle.")
+    parser.add_argument("bundle", help="path of the model bundle written by helper.save_model_bundle")
+    parser.add_argument("input", nargs="?", help="csv file of patient rows to score")
+    parser.add_argument("--output", help="csv file for the scores, printed when omitted")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--serve", action="store_true", help="run the HTTP scoring server")
+    parser.add_argument("--store", help="feature store to look patients up in, see helper.write_feature_store")
+    parser.add_argument("--patients", nargs="*", type=int, help="patients of the store to score, all by default")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=256, help="rows per micro-batch")
+    parser.add_argument("--max-wait", type=float, default=0.002, help="seconds to wait to fill a micro-batch")
+    args = parser.parse_args()
+
+    bundle = helper.load_model_bundle(args.bundle)
+    store = helper.open_feature_store(args.store) if args.store else None
+
+    if args.serve:
+        serve(bundle, args.host, args.port, args.max_batch, args.max_wait, store)
+        return
+    elif args.input:
+        result = score_file(bundle, args.input, args.output, args.batch_size)
+    elif store is not None:
+        result = score_patients(bundle, store, args.patients, args.output, args.batch_size)
+    else:
+        parser.error("give an input csv, --store or --serve")
+    if not args.output:
+        print(result.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()